@@ -0,0 +1,283 @@
+import os
+import sys
+import json
+import base64
+import time
+import platform
+import statistics
+import subprocess
+import tempfile
+from typing import List
+
+from shell_emulator import (ShellCore, BufferSink, StreamSink, VfsIndex, Scrollback, tokenize,
+                            write_binary_image)
+
+
+# Бенчмарки горячих путей VFS и команд. Синтетический образ VFS
+# генерируется во временном каталоге, результаты пишутся в JSON и
+# сравниваются с результатами другого коммита:
+#   python benchmark.py --output=before.json
+#   python benchmark.py --output=after.json --compare=before.json
+
+DEFAULT_SIZES = "1KB,1MB,16MB"
+DEFAULT_WIDE = 10000
+DEFAULT_DEPTH = 200
+DEFAULT_REPEAT = 5
+DEFAULT_THRESHOLD = 1.10
+
+_UNITS = {"KB": 1024, "MB": 1024 ** 2, "GB": 1024 ** 3}
+
+# Текст файлов: строки с повторами подряд, чтобы uniq было что схлопывать
+_BLOCK = b"".join(f"line {number % 97} of synthetic file, word{number % 13}\n".encode("ascii")
+                  * (1 + number % 3) for number in range(1000))
+
+
+def parse_size(text: str) -> int:
+    text = text.strip().upper()
+    for unit, factor in _UNITS.items():
+        if text.endswith(unit):
+            return int(float(text[:-len(unit)]) * factor)
+    return int(text)
+
+
+def size_label(size: int) -> str:
+    for unit in ("GB", "MB", "KB"):
+        if size >= _UNITS[unit] and size % _UNITS[unit] == 0:
+            return f"{size // _UNITS[unit]}{unit}"
+    return str(size)
+
+
+def _write_base64(f, size: int):
+    # base64 пишется кусками, кратными 3 байтам, чтобы файл любого размера
+    # не собирался в памяти целиком
+    chunk = _BLOCK * (3 * 1024 * 1024 // len(_BLOCK) + 1)
+    chunk = chunk[:len(chunk) // 3 * 3]
+    left = size
+    while left > 0:
+        part = chunk[:left] if left < len(chunk) else chunk
+        f.write(base64.b64encode(part).decode("ascii"))
+        left -= len(part)
+
+
+def _write_file_node(f, name: str, size: int):
+    f.write(f'{json.dumps(name)}: {{"type": "file", "name": {json.dumps(name)}, "content": "')
+    _write_base64(f, size)
+    f.write('"}')
+
+
+def generate_vfs(path: str, sizes: List[int], wide: int, depth: int):
+    # Три части образа: /wide — директория с wide маленькими файлами,
+    # /deep — цепочка из depth вложенных директорий, /big — файлы заданных
+    # размеров. Возвращает путь к файлу в конце цепочки.
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('{"type": "dir", "name": "/", "children": {')
+        f.write('"wide": {"type": "dir", "name": "wide", "children": {')
+        for number in range(wide):
+            if number:
+                f.write(", ")
+            _write_file_node(f, f"file{number}.txt", 64)
+        f.write("}}, ")
+        f.write('"deep": {"type": "dir", "name": "deep", "children": {')
+        for level in range(depth):
+            f.write(f'"d{level}": {{"type": "dir", "name": "d{level}", "children": {{')
+        _write_file_node(f, "leaf.txt", 64)
+        f.write("}}" * (depth + 1))
+        f.write(', "big": {"type": "dir", "name": "big", "children": {')
+        for number, size in enumerate(sizes):
+            if number:
+                f.write(", ")
+            _write_file_node(f, f"{size_label(size)}.txt", size)
+        f.write("}}}}\n")
+    return "/deep/" + "/".join(f"d{level}" for level in range(depth)) + "/leaf.txt"
+
+
+def measure(func, repeat: int, setup=None) -> dict:
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        started = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - started)
+    return {"min": min(times), "median": statistics.median(times), "runs": repeat}
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def run_benchmarks(work_dir: str, sizes: List[int], wide: int, depth: int, repeat: int) -> dict:
+    results = {}
+
+    def record(name, func, setup=None, runs=repeat):
+        results[name] = measure(func, runs, setup)
+        print(f"  {name:<32} {results[name]['min'] * 1000:12.3f} мс")
+
+    vfs_path = os.path.join(work_dir, "bench_vfs.json")
+    image_path = os.path.join(work_dir, "bench_vfs.img")
+    started = time.perf_counter()
+    deep_path = generate_vfs(vfs_path, sizes, wide, depth)
+    print(f"Образ {os.path.getsize(vfs_path) / 1024 ** 2:.1f} МБ сгенерирован "
+          f"за {time.perf_counter() - started:.1f} с")
+
+    sink = BufferSink()
+    shell = ShellCore(sink=sink, plan_cache_dir=None)
+    lazy_shell = ShellCore(sink=sink, lazy_vfs=True, plan_cache_dir=None)
+
+    record("load_vfs/json", lambda: shell.load_vfs(vfs_path), runs=max(1, repeat // 2))
+    write_binary_image(shell.vfs, image_path)
+    record("load_vfs/json_lazy", lambda: lazy_shell.load_vfs(vfs_path))
+    record("load_vfs/image", lambda: lazy_shell.load_vfs(image_path))
+    shell.load_vfs(vfs_path)
+
+    def reset_index():
+        shell.vfs_index = VfsIndex(shell.vfs)
+
+    record("get_node_by_path/deep_cold", lambda: shell.get_node_by_path(deep_path), reset_index)
+    record("get_node_by_path/deep_warm", lambda: [shell.get_node_by_path(deep_path) for _ in range(1000)])
+    wide_paths = [f"/wide/file{number}.txt" for number in range(0, wide, max(1, wide // 1000))]
+    record("get_node_by_path/wide_cold", lambda: [shell.get_node_by_path(path) for path in wide_paths],
+           reset_index)
+
+    record("cmd_ls/wide", lambda: shell.cmd_ls(["/wide"]), sink.clear)
+    record("cmd_ls/root", lambda: [shell.cmd_ls(["/"]) for _ in range(1000)], sink.clear)
+    deep_dir = deep_path.rsplit("/", 1)[0]
+    record("cmd_cd/deep", lambda: [(shell.cmd_cd([deep_dir]), shell.cmd_cd([".."]), shell.cmd_cd(["/"]))
+                                   for _ in range(100)], sink.clear)
+
+    def mv_back_and_forth():
+        for _ in range(100):
+            shell.cmd_mv(["/wide/file0.txt", "/wide/moved.txt"])
+            shell.cmd_mv(["/wide/moved.txt", "/wide/file0.txt"])
+
+    record("cmd_mv/wide", mv_back_and_forth, sink.clear)
+
+    def cold_cache():
+        sink.clear()
+        shell.content_cache.clear()
+
+    for size in sizes:
+        path = f"/big/{size_label(size)}.txt"
+        runs = repeat if size <= 64 * _UNITS["MB"] else 1
+        record(f"cmd_wc/{size_label(size)}", lambda path=path: shell.cmd_wc([path]), cold_cache, runs)
+        record(f"cmd_uniq/{size_label(size)}", lambda path=path: shell.cmd_uniq(["-c", path]),
+               cold_cache, runs)
+
+    # Разбор строк так, как их разбирает ввод: конвейеры и перенаправления
+    lines = [f"mv /wide/file{number}.txt /wide/f{number}.txt" for number in range(1000)]
+    lines += [f'wc "/big/{size_label(size)}.txt"' for size in sizes] * 100
+    lines += [f'cat "/big/{size_label(size)}.txt" | uniq -c | wc > /out{number}.txt'
+              for number, size in enumerate(sizes * 100)]
+    record("parse_pipeline/cold", lambda: [shell.parse_pipeline(line) for line in lines],
+           tokenize.cache_clear)
+    record("parse_pipeline/warm", lambda: [shell.parse_pipeline(line) for line in lines])
+    small = f"/big/{size_label(min(sizes))}.txt"
+    record("execute_command/pipeline",
+           lambda: [shell.execute_command_from_script(f"cat {small} | uniq -c | wc") for _ in range(100)],
+           sink.clear)
+
+    with open(os.devnull, "w", encoding="utf-8") as devnull:
+        headless = ShellCore(sink=StreamSink(devnull), plan_cache_dir=None)
+        text = "output line of a headless run\n"
+        record("print_output/headless", lambda: [headless.print_output(text) for _ in range(100000)])
+
+    # Буфер панели вывода: миллион строк пачками и чтение окна из середины
+    chunk = "".join(f"output line {number}\n" for number in range(4096))
+    scrollbacks = [Scrollback(None)]
+
+    def fill_scrollback():
+        scrollbacks[0] = Scrollback(None)
+        for _ in range(245):
+            scrollbacks[0].append(chunk)
+
+    record("scrollback/append_1M", fill_scrollback, runs=max(1, repeat // 2))
+    store = scrollbacks[0].store
+    middle = store.end // 2
+    record("scrollback/viewport", lambda: [store.lines(middle, middle + 500) for _ in range(100)])
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> int:
+    # Сравнение по минимальному времени; регрессия — замедление больше threshold
+    regressions = 0
+    print(f"\n{'бенчмарк':<34}{'было, мс':>12}{'стало, мс':>12}{'отношение':>11}")
+    for name, result in results.items():
+        old = baseline.get(name)
+        if old is None:
+            print(f"{name:<34}{'-':>12}{result['min'] * 1000:12.3f}{'новый':>11}")
+            continue
+        ratio = result["min"] / old["min"] if old["min"] else float("inf")
+        mark = "  регрессия" if ratio > threshold else ""
+        regressions += bool(mark)
+        print(f"{name:<34}{old['min'] * 1000:12.3f}{result['min'] * 1000:12.3f}{ratio:10.2f}x{mark}")
+    return regressions
+
+
+def main():
+    sizes_text = DEFAULT_SIZES
+    wide = DEFAULT_WIDE
+    depth = DEFAULT_DEPTH
+    repeat = DEFAULT_REPEAT
+    threshold = DEFAULT_THRESHOLD
+    output_path = None
+    compare_path = None
+    work_dir = None
+
+    for arg in sys.argv[1:]:
+        if arg.startswith('--sizes='):
+            sizes_text = arg.split('=', 1)[1]
+        elif arg.startswith('--wide='):
+            wide = int(arg.split('=', 1)[1])
+        elif arg.startswith('--depth='):
+            depth = int(arg.split('=', 1)[1])
+        elif arg.startswith('--repeat='):
+            repeat = int(arg.split('=', 1)[1])
+        elif arg.startswith('--threshold='):
+            threshold = float(arg.split('=', 1)[1])
+        elif arg.startswith('--output='):
+            output_path = arg.split('=', 1)[1]
+        elif arg.startswith('--compare='):
+            compare_path = arg.split('=', 1)[1]
+        elif arg.startswith('--work-dir='):
+            work_dir = arg.split('=', 1)[1]
+        else:
+            print(f"Неизвестный аргумент: {arg}")
+            return 2
+
+    sizes = [parse_size(size) for size in sizes_text.split(",") if size.strip()]
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp_dir:
+        results = run_benchmarks(tmp_dir, sizes, wide, depth, repeat)
+
+    report = {
+        "meta": {
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "params": {"sizes": [size_label(size) for size in sizes], "wide": wide,
+                       "depth": depth, "repeat": repeat}
+        },
+        "results": results
+    }
+    if output_path:
+        with open(output_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Результаты записаны в {output_path}")
+
+    if compare_path:
+        with open(compare_path, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline.get("results", {}), threshold)
+        if regressions:
+            print(f"Регрессий: {regressions}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
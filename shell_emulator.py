@@ -1,5 +1,3 @@
-import tkinter as tk
-from tkinter import scrolledtext, font
 import os
 import sys
 import shlex
@@ -8,234 +6,2300 @@ import getpass
 import platform
 import json
 import base64
-
-
-
-
-class TerminalEmulator:
-    def __init__(self, root, vfs_path=None, startup_script=None):
-        self.root = root
-
-        self.vfs_path = vfs_path or os.getcwd()
-
-        self.startup_script = startup_script
-
-        self.current_dir = self.vfs_path
-
-        self.root.title(self.get_window_title())
-
-        self.current_dir = "/"
-
-        self.terminal_font = font.Font(family="Courier New", size=10)
-
-        self.create_widgets()
-
-        self.welcome_message()
-
-        self.vfs = {}
-        if self.vfs_path:
-            self.load_vfs(self.vfs_path)
-        else:
-            # VFS по умолчанию, если файл не указан
-            self.vfs = {
+import mmap
+import re
+import codecs
+import functools
+import itertools
+import bisect
+import struct
+import hashlib
+import queue
+import threading
+import time
+import multiprocessing
+from collections import OrderedDict
+from array import array
+
+try:
+    import tkinter as tk
+    from tkinter import font, simpledialog
+except ImportError:
+    # Без Tk доступен только режим --headless
+    tk = None
+
+
+def default_vfs() -> dict:
+    # VFS по умолчанию, если файл не указан
+    return {
+        "type": "dir",
+        "name": "/",
+        "children": {
+            "file1.txt": {
+                "type": "file",
+                "name": "file1.txt",
+                "content": "SGVsbG8gd29ybGQh"  # base64
+            },
+            "docs": {
                 "type": "dir",
-                "name": "/",
+                "name": "docs",
                 "children": {
-                    "file1.txt": {
+                    "readme.txt": {
                         "type": "file",
-                        "name": "file1.txt",
-                        "content": "SGVsbG8gd29ybGQh"  # base64
+                        "name": "readme.txt",
+                        "content": "VGhpcyBpcyBhIHJlYWRtZSBmaWxlLg=="
                     },
-                    "docs": {
+                    "images": {
                         "type": "dir",
-                        "name": "docs",
-                        "children": {
-                            "readme.txt": {
-                                "type": "file",
-                                "name": "readme.txt",
-                                "content": "VGhpcyBpcyBhIHJlYWRtZSBmaWxlLg=="
-                            },
-                            "images": {
-                                "type": "dir",
-                                "name": "images",
-                                "children": {}
-                            }
-                        }
-                    },
-                    "projects": {
+                        "name": "images",
+                        "children": {}
+                    }
+                }
+            },
+            "projects": {
+                "type": "dir",
+                "name": "projects",
+                "children": {
+                    "project1": {
                         "type": "dir",
-                        "name": "projects",
+                        "name": "project1",
                         "children": {
-                            "project1": {
-                                "type": "dir",
-                                "name": "project1",
-                                "children": {
-                                    "main.py": {
-                                        "type": "file",
-                                        "name": "main.py",
-                                        "content": "cHJpbnQoIkhlbGxvIFByb2plY3QhIik="
-                                    }
-                                }
+                            "main.py": {
+                                "type": "file",
+                                "name": "main.py",
+                                "content": "cHJpbnQoIkhlbGxvIFByb2plY3QhIik="
                             }
                         }
                     }
                 }
             }
+        }
+    }
+
+
+NODE_DIR = 0x1
+NODE_FILE = 0x2
+NODE_LAZY = 0x4
+NODE_RAW = 0x8
+# Старшие биты flags — эпоха узла для копирования при записи (снимки VFS)
+NODE_EPOCH_SHIFT = 8
+NODE_LOW_MASK = (1 << NODE_EPOCH_SHIFT) - 1
+
+
+class VfsNode:
+    # Компактный узел VFS. Имя интернировано и совпадает с ключом в children
+    # родителя, тип хранится битами в flags. У директории children — словарь
+    # "имя -> узел", у файла content — содержимое в base64 или, с флагом
+    # NODE_RAW, сами байты (срез mmap бинарного образа). При ленивой загрузке
+    # (NODE_LAZY) content — ссылка (источник, a, b), по которой источник
+    # читает содержимое файла или список детей директории при первом обращении.
+    __slots__ = ("name", "flags", "children", "content")
+
+    def __init__(self, name: str, flags: int, children=None, content=None):
+        self.name = name
+        self.flags = flags
+        self.children = children
+        self.content = content
+
+    @property
+    def is_dir(self) -> bool:
+        return bool(self.flags & NODE_DIR)
+
+    @property
+    def is_file(self) -> bool:
+        return bool(self.flags & NODE_FILE)
+
+    @property
+    def epoch(self) -> int:
+        return self.flags >> NODE_EPOCH_SHIFT
+
+    def copy(self, epoch: int):
+        # Неглубокая копия для изменения: дети и содержимое общие с
+        # оригиналом. Записанный буфер отдаётся только для чтения, поэтому
+        # дописывание в копию его скопирует, а снимок не изменится.
+        flags = (self.flags & NODE_LOW_MASK) | epoch << NODE_EPOCH_SHIFT
+        if self.is_dir:
+            return VfsNode(self.name, flags & ~NODE_LAZY, dict(self.get_children()))
+        content = self.content
+        if isinstance(content, bytearray):
+            content = memoryview(content).toreadonly()
+        return VfsNode(self.name, flags, content=content)
+
+    def get_children(self) -> dict:
+        if self.flags & NODE_LAZY:
+            source, first, count = self.content
+            self.children = source.read_children(first, count)
+            self.content = None
+            self.flags &= ~NODE_LAZY
+        return self.children
+
+    def get_content(self):
+        if self.flags & NODE_LAZY:
+            source, start, end = self.content
+            self.content = source.read_content(start, end)
+            self.flags = (self.flags & ~NODE_LAZY) | source.content_flags
+        return self.content
+
+    def peek_content(self):
+        # Содержимое и признак NODE_RAW без сохранения в узле: большой файл
+        # ленивого образа читается потоком прямо из mmap
+        if self.flags & NODE_LAZY:
+            source, start, end = self.content
+            return source.peek_content(start, end), source.content_flags
+        return self.content, self.flags & NODE_RAW
+
+    def peek_children(self) -> dict:
+        # Дети без сохранения в узле: запись образа обходит ленивое дерево,
+        # не разворачивая его в памяти
+        if self.flags & NODE_LAZY:
+            source, first, count = self.content
+            return source.read_children(first, count)
+        return self.children
+
+    def get_bytes(self):
+        content = self.get_content()
+        if self.flags & NODE_RAW:
+            return content
+        return base64.b64decode(content)
+
+    def open_write(self, append: bool = False) -> bytearray:
+        # Содержимое файла для записи: растущий bytearray с флагом NODE_RAW.
+        # Дописывание расширяет его на месте, base64 не перекодируется.
+        if not append:
+            content = bytearray()
+        elif self.flags & NODE_RAW and isinstance(self.content, bytearray):
+            return self.content
+        else:
+            content = bytearray(self.get_bytes())
+        self.content = content
+        self.flags = (self.flags & ~NODE_LAZY) | NODE_RAW
+        return content
+
+
+def empty_vfs() -> VfsNode:
+    return VfsNode("/", NODE_DIR, {})
+
+
+def _node_from_dict(data: dict) -> VfsNode:
+    # children уже содержит готовые VfsNode; имя узла берётся из ключа,
+    # чтобы не хранить одну и ту же строку дважды
+    if data.get("type") == "dir":
+        children = {}
+        for key, child in data.get("children", {}).items():
+            key = sys.intern(key)
+            child.name = key
+            children[key] = child
+        return VfsNode(sys.intern(data.get("name", "")), NODE_DIR, children)
+    return VfsNode(sys.intern(data.get("name", "")), NODE_FILE, content=data.get("content", ""))
+
+
+def _vfs_object_hook(data: dict):
+    # Вызывается json для каждого объекта снизу вверх: узлы превращаются в
+    # VfsNode сразу при разборе, промежуточные словари не накапливаются.
+    # Словари children (значения — уже VfsNode) возвращаются как есть.
+    if isinstance(data.get("type"), str):
+        return _node_from_dict(data)
+    return data
+
+
+def node_from_json(data: dict) -> VfsNode:
+    if data.get("type") == "dir":
+        data = dict(data, children={name: node_from_json(child)
+                                    for name, child in data.get("children", {}).items()})
+    return _node_from_dict(data)
+
+
+_JSON_TOKEN = re.compile(rb'[ \t\n\r]*(?:([{}\[\],:])|(")|(true|false|null|-?[0-9][0-9.eE+-]*))')
+_JSON_SPACE = re.compile(rb'[ \t\n\r]*')
+# Файл в обычной записи vfs.json ({"type": "file", "name": ..., "content":
+# ...}) разбирается одним совпадением вместо разбора по токенам
+_JSON_FILE_NODE = re.compile(rb'\{[ \t\n\r]*"type"[ \t\n\r]*:[ \t\n\r]*"file"[ \t\n\r]*,'
+                             rb'[ \t\n\r]*"name"[ \t\n\r]*:[ \t\n\r]*"[^"\\]*(?:\\.[^"\\]*)*"'
+                             rb'[ \t\n\r]*,[ \t\n\r]*"content"[ \t\n\r]*:[ \t\n\r]*(")')
+_JSON_OBJECT_END = re.compile(rb'[ \t\n\r]*\}')
+# Ключ без escape-последовательностей вместе с двоеточием
+_JSON_KEY = re.compile(rb'"([^"\\]*)"[ \t\n\r]*:')
+# Запись children "ключ": {файл} до начала content и её окончание
+_JSON_FILE_ENTRY = re.compile(rb'[ \t\n\r]*"([^"\\]*)"[ \t\n\r]*:[ \t\n\r]*' + _JSON_FILE_NODE.pattern)
+_JSON_ENTRY_END = re.compile(rb'[ \t\n\r]*\}[ \t\n\r]*([,}])')
+# Пропуск объекта целиком: строки поглощаются регулярным выражением,
+# вложенность считается по фигурным скобкам
+_JSON_BRACE = re.compile(rb'[^{}"]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^{}"]*)*([{}])')
+
+
+class LazyJsonSource:
+    # Ленивая загрузка vfs.json. Файл отображается в память, строки
+    # "content" не декодируются, а объекты "children" при загрузке только
+    # пропускаются быстрым поиском скобок: в узле остаются их смещения,
+    # содержимое файла или список детей разбирается при первом обращении.
+    # Поэтому ошибка внутри директории обнаружится при первом обращении к ней.
+    content_flags = 0
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def parse(self) -> VfsNode:
+        root, pos = self._value(0)
+        if _JSON_SPACE.match(self.buf, pos).end() != len(self.buf):
+            self._error(pos)
+        return root
+
+    def read_children(self, start: int, end: int) -> dict:
+        # Подряд идущие обычные записи файлов разбираются одним совпадением
+        # на запись, с первой необычной записи — общий разбор остатка
+        buf = self.buf
+        children = {}
+        pos = start + 1
+        while True:
+            match = _JSON_FILE_ENTRY.match(buf, pos)
+            if match is None:
+                break
+            content_start = match.start(2)
+            content_end = self._string_end(content_start)
+            close = _JSON_ENTRY_END.match(buf, content_end)
+            if close is None:
+                break
+            key = sys.intern(str(match.group(1), "utf-8"))
+            children[key] = VfsNode(key, NODE_FILE | NODE_LAZY, content=(self, content_start, content_end))
+            pos = close.end()
+            if close.group(1) == b"}":
+                return children
+        data, _ = self._object(pos)
+        if not isinstance(data, dict) or not all(isinstance(child, VfsNode) for child in data.values()):
+            self._error(start)
+        for key, child in data.items():
+            key = sys.intern(key)
+            child.name = key
+            children[key] = child
+        return children
+
+    def read_content(self, start: int, end: int) -> str:
+        raw = self.buf[start:end]
+        if b"\\" in raw:
+            return json.loads(raw)
+        return raw[1:-1].decode("utf-8")
+
+    def peek_content(self, start: int, end: int):
+        if self.buf.find(b"\\", start, end) != -1:
+            return json.loads(self.buf[start:end])
+        return memoryview(self.buf)[start + 1:end - 1]
+
+    def close(self):
+        try:
+            self.buf.close()
+        except BufferError:
+            # На буфер ещё ссылаются узлы, mmap закроется сборщиком мусора
+            pass
+
+    def _string(self, start: int, end: int) -> str:
+        # Строка без escape-последовательностей декодируется напрямую
+        if self.buf.find(b"\\", start, end) == -1:
+            return str(self.buf[start + 1:end - 1], "utf-8")
+        return json.loads(self.buf[start:end])
+
+    def _error(self, pos: int):
+        raise ValueError(f"неверный JSON в позиции {pos}")
+
+    def _token(self, pos: int):
+        match = _JSON_TOKEN.match(self.buf, pos)
+        if match is None:
+            self._error(pos)
+        return match
+
+    def _string_end(self, start: int) -> int:
+        # Конец строки ищется через find, без посимвольного разбора: так
+        # большие base64-блоки пропускаются со скоростью memchr
+        buf = self.buf
+        end = buf.find(b'"', start + 1)
+        while end != -1:
+            backslashes = 0
+            while buf[end - 1 - backslashes] == 0x5C:
+                backslashes += 1
+            if backslashes % 2 == 0:
+                return end + 1
+            end = buf.find(b'"', end + 1)
+        self._error(start)
+
+    def _skip_object(self, pos: int) -> int:
+        depth = 0
+        for match in _JSON_BRACE.finditer(self.buf, pos):
+            if match.group(1) == b"{":
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return match.end()
+        self._error(pos)
+
+    def _file_node(self, pos: int):
+        match = _JSON_FILE_NODE.match(self.buf, pos)
+        if match is None:
+            return None
+        start = match.start(1)
+        end = self._string_end(start)
+        close = _JSON_OBJECT_END.match(self.buf, end)
+        if close is None:
+            # После content есть другие ключи — разбор по токенам
+            return None
+        # Имя узлу даёт ключ в children родителя (read_children)
+        return VfsNode("", NODE_FILE | NODE_LAZY, content=(self, start, end)), close.end()
+
+    def _value(self, pos: int, key=None):
+        match = self._token(pos)
+        punct, quote, literal = match.groups()
+        if quote:
+            start = match.end() - 1
+            end = self._string_end(start)
+            if key == "content":
+                return (self, start, end), end
+            return self._string(start, end), end
+        if literal:
+            return json.loads(literal), match.end()
+        if punct == b"{":
+            if key == "children":
+                brace = match.end() - 1
+                end = self._skip_object(brace)
+                return (self, brace, end), end
+            return self._file_node(match.end() - 1) or self._object(match.end())
+        if punct == b"[":
+            return self._array(match.end())
+        self._error(pos)
+
+    def _object(self, pos: int):
+        data = {}
+        match = self._token(pos)
+        if match.group(1) == b"}":
+            return _vfs_object_hook(data), match.end()
+        while True:
+            if not match.group(2):
+                self._error(match.start())
+            start = match.end() - 1
+            simple = _JSON_KEY.match(self.buf, start)
+            if simple is not None:
+                key = str(simple.group(1), "utf-8")
+                pos = simple.end()
+            else:
+                end = self._string_end(start)
+                key = self._string(start, end)
+                match = self._token(end)
+                if match.group(1) != b":":
+                    self._error(end)
+                pos = match.end()
+            data[key], pos = self._value(pos, key)
+            match = self._token(pos)
+            if match.group(1) == b"}":
+                break
+            if match.group(1) != b",":
+                self._error(pos)
+            match = self._token(match.end())
+        children = data.get("children")
+        if isinstance(children, tuple):
+            data["children"] = {}
+        node = _vfs_object_hook(data)
+        if isinstance(node, VfsNode):
+            if node.is_dir and isinstance(children, tuple):
+                node.children = None
+                node.content = children
+                node.flags |= NODE_LAZY
+            elif node.is_file and isinstance(node.content, tuple):
+                node.flags |= NODE_LAZY
+        return node, match.end()
+
+    def _array(self, pos: int):
+        items = []
+        match = self._token(pos)
+        if match.group(1) == b"]":
+            return items, match.end()
+        while True:
+            value, pos = self._value(match.start())
+            items.append(value)
+            match = self._token(pos)
+            if match.group(1) == b"]":
+                return items, match.end()
+            if match.group(1) != b",":
+                self._error(pos)
+            match = self._token(match.end())
+
+
+VFS_IMAGE_MAGIC = b"SHVFSIMG"
+VFS_IMAGE_VERSION = 1
+# magic, версия, число записей, смещения таблицы, имён и данных
+_IMAGE_HEADER = struct.Struct("<8sIIQQQ")
+# флаги, смещение и длина имени, первый ребёнок и число детей (у директории),
+# смещение и длина содержимого (у файла)
+_IMAGE_ENTRY = struct.Struct("<IIIIIQQ")
+_BASE64_CHUNK = 3 * 64 * 1024
+
+
+class BinaryVfsSource:
+    # Бинарный образ VFS: заголовок, таблица записей и области имён и данных.
+    # Записи идут в порядке обхода в ширину, дети каждой директории лежат
+    # подряд и отсортированы по имени. Файл открывается через mmap, узлы
+    # создаются при первом обращении к директории, содержимое файла — срез
+    # memoryview без копирования.
+    content_flags = NODE_RAW
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.buf)
+        try:
+            (magic, version, self.count, self.table_offset,
+             self.names_offset, self.data_offset) = _IMAGE_HEADER.unpack_from(self.buf, 0)
+        except struct.error:
+            raise ValueError("повреждённый заголовок образа VFS")
+        if magic != VFS_IMAGE_MAGIC or version != VFS_IMAGE_VERSION:
+            raise ValueError("неподдерживаемый формат образа VFS")
+
+    def parse(self) -> VfsNode:
+        return self._node(0)
+
+    def read_children(self, first: int, count: int) -> dict:
+        children = {}
+        for index in range(first, first + count):
+            child = self._node(index)
+            children[child.name] = child
+        return children
+
+    def read_content(self, offset: int, length: int):
+        start = self.data_offset + offset
+        return self.view[start:start + length]
+
+    peek_content = read_content
+
+    def close(self):
+        try:
+            self.view.release()
+            self.buf.close()
+        except BufferError:
+            pass
+
+    def _node(self, index: int) -> VfsNode:
+        if index >= self.count:
+            raise ValueError("повреждённая таблица образа VFS")
+        flags, name_offset, name_length, first, count, data_offset, data_length = \
+            _IMAGE_ENTRY.unpack_from(self.buf, self.table_offset + index * _IMAGE_ENTRY.size)
+        start = self.names_offset + name_offset
+        name = sys.intern(str(self.view[start:start + name_length], "utf-8"))
+        if flags & NODE_DIR:
+            return VfsNode(name, NODE_DIR | NODE_LAZY, content=(self, first, count))
+        return VfsNode(name, NODE_FILE | NODE_LAZY, content=(self, data_offset, data_length))
+
+
+def is_binary_image(path: str) -> bool:
+    with open(path, "rb") as f:
+        return f.read(len(VFS_IMAGE_MAGIC)) == VFS_IMAGE_MAGIC
+
+
+def write_binary_image(root: VfsNode, path: str):
+    # Данные файлов пишутся потоком сразу после заголовка, таблица и имена —
+    # в конце, затем заголовок переписывается с настоящими смещениями
+    entries = [root]
+    table = []
+    names = bytearray()
+    with open(path, "wb") as f:
+        f.write(b"\0" * _IMAGE_HEADER.size)
+        data_offset = f.tell()
+        index = 0
+        while index < len(entries):
+            node = entries[index]
+            name = node.name.encode("utf-8")
+            first = count = file_offset = file_length = 0
+            if node.is_dir:
+                children = node.peek_children()
+                first, count = len(entries), len(children)
+                entries.extend(children[key] for key in sorted(children))
+            else:
+                # Содержимое читается кусками без сохранения в узле, поэтому
+                # ленивый образ не загружается в память целиком
+                file_offset = f.tell() - data_offset
+                for data in iter_node_bytes(node):
+                    f.write(data)
+                file_length = f.tell() - data_offset - file_offset
+            table.append(_IMAGE_ENTRY.pack(node.flags & (NODE_DIR | NODE_FILE), len(names),
+                                           len(name), first, count, file_offset, file_length))
+            names += name
+            index += 1
+        names_offset = f.tell()
+        f.write(names)
+        table_offset = f.tell()
+        f.write(b"".join(table))
+        f.seek(0)
+        f.write(_IMAGE_HEADER.pack(VFS_IMAGE_MAGIC, VFS_IMAGE_VERSION, len(entries),
+                                   table_offset, names_offset, data_offset))
+
+
+def write_json_image(root: VfsNode, path: str):
+    # Потоковая запись в формате vfs.json (как json.dump с indent=2), без
+    # построения промежуточного словаря всего дерева
+    with open(path, "w", encoding="utf-8") as f:
+        _write_json_node(f, root, "")
+        f.write("\n")
+
+
+def _write_json_node(f, node: VfsNode, indent: str):
+    inner = indent + "  "
+    kind = "dir" if node.is_dir else "file"
+    f.write(f'{{\n{inner}"type": "{kind}",\n{inner}"name": {json.dumps(node.name, ensure_ascii=False)},\n')
+    if node.is_dir:
+        children = node.peek_children()
+        f.write(f'{inner}"children": {{')
+        for position, (name, child) in enumerate(children.items()):
+            f.write(f'{"," if position else ""}\n{inner}  {json.dumps(name, ensure_ascii=False)}: ')
+            _write_json_node(f, child, inner + "  ")
+        f.write(f"\n{inner}}}" if children else "}")
+    else:
+        f.write(f'{inner}"content": "')
+        data, raw = node.peek_content()
+        if raw:
+            for start in range(0, len(data), _BASE64_CHUNK):
+                f.write(base64.b64encode(data[start:start + _BASE64_CHUNK]).decode("ascii"))
+        elif isinstance(data, str):
+            f.write(data)
+        else:
+            # base64 прямо из mmap ленивого JSON
+            for start in range(0, len(data), _BASE64_CHUNK):
+                f.write(str(data[start:start + _BASE64_CHUNK], "ascii"))
+        f.write('"')
+    f.write(f"\n{indent}}}")
+
+
+def convert_vfs(source_path: str, target_path: str):
+    # JSON -> бинарный образ и обратно; формат результата по расширению:
+    # .json — JSON, иначе бинарный образ. Запись атомарная через os.replace.
+    if is_binary_image(source_path):
+        source = BinaryVfsSource(source_path)
+    else:
+        source = LazyJsonSource(source_path)
+    try:
+        root = source.parse()
+        if not isinstance(root, VfsNode) or not root.is_dir:
+            raise ValueError("корень VFS должен быть директорией")
+        save_image(root, target_path, not target_path.endswith(".json"))
+    finally:
+        root = None
+        source.close()
+
+
+def _fsync_path(path: str, directory: bool = False):
+    if directory:
+        # Каталог открывается только на POSIX; без этого rename может не
+        # пережить сбой питания, но сам файл уже записан
+        try:
+            fd = os.open(path or ".", os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+        return
+    with open(path, "rb+") as f:
+        os.fsync(f.fileno())
+
+
+def save_image(root: VfsNode, path: str, binary=None):
+    # Атомарная запись образа: временный файл, fsync, os.replace. Формат
+    # сохраняется как у существующего файла, новый файл — по расширению
+    # (.json — JSON, иначе бинарный образ).
+    if binary is None:
+        binary = is_binary_image(path) if os.path.isfile(path) else not path.endswith(".json")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        if binary:
+            write_binary_image(root, tmp_path)
+        else:
+            write_json_image(root, tmp_path)
+        _fsync_path(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    _fsync_path(os.path.dirname(path), directory=True)
+
+
+JOURNAL_FORMAT_VERSION = 1
+JOURNAL_COMPACT_BYTES = 1024 * 1024
+
+
+class VfsJournal:
+    # Журнал изменений VFS рядом с образом (<образ>.journal). Первая строка —
+    # заголовок с размером и mtime образа, дальше по JSON-строке на операцию.
+    # При загрузке операции повторяются поверх образа; журнал от другой
+    # версии образа не применяется. Запись в журнал стоит пропорционально
+    # изменению, образ пересобирается, когда журнал становится слишком большим.
+    def __init__(self, image_path: str, autosave: bool = False):
+        self.image_path = image_path
+        self.path = image_path + ".journal"
+        self.autosave = autosave
+        # Операции, ещё не записанные в файл (без autosave — до команды save)
+        self.pending = []
+        # Байт операций в файле журнала
+        self.size = 0
+        # Файл журнала относится к текущему образу и его можно дописывать
+        self.valid = False
+        # Изменения не выражены операциями: нужна пересборка образа целиком
+        self.full = False
+
+    def header(self) -> dict:
+        stat = os.stat(self.image_path)
+        return {"journal": JOURNAL_FORMAT_VERSION, "image_size": stat.st_size,
+                "image_mtime_ns": stat.st_mtime_ns}
+
+    def read(self):
+        # Операции журнала или None, если журнал от другой версии образа.
+        # Недописанная при сбое последняя строка отбрасывается.
+        if not os.path.isfile(self.path):
+            return []
+        ops = []
+        with open(self.path, "rb") as f:
+            try:
+                header = json.loads(f.readline())
+            except ValueError:
+                header = None
+            if header != self.header():
+                return None
+            start = end = f.tell()
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    ops.append(json.loads(line))
+                except ValueError:
+                    break
+                end += len(line)
+        if end != os.path.getsize(self.path):
+            os.truncate(self.path, end)
+        self.valid = True
+        self.size = end - start
+        return ops
+
+    def record(self, op: dict):
+        self.pending.append(json.dumps(op, ensure_ascii=False) + "\n")
+
+    def flush(self):
+        if not self.pending:
+            return
+        if not self.valid:
+            self.reset()
+        data = "".join(self.pending).encode("utf-8")
+        with open(self.path, "ab") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self.size += len(data)
+        self.pending = []
+
+    def reset(self):
+        # Пустой журнал с заголовком текущего образа, атомарно
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(json.dumps(self.header()) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.valid = True
+        self.size = 0
+
+    def needs_compaction(self) -> bool:
+        return self.full or self.size > max(JOURNAL_COMPACT_BYTES,
+                                            os.path.getsize(self.image_path) // 2)
+
+    def compact(self, root: VfsNode):
+        # Сначала заменяется образ, потом журнал. При сбое между ними старый
+        # журнал не совпадёт по заголовку с новым образом и не применится.
+        save_image(root, self.image_path)
+        self.pending = []
+        self.full = False
+        self.reset()
+
+
+DEFAULT_CONTENT_CACHE_BYTES = 64 * 1024 * 1024
+# В кэш попадает файл не больше этой доли бюджета, чтобы один файл не
+# вытеснял все остальные
+CONTENT_CACHE_FILE_SHARE = 4
+
+
+class ContentCache:
+    # LRU-кэш декодированного текста файлов с бюджетом в байтах. Ключ — сам
+    # узел, поэтому mv не делает запись устаревшей: по старому пути узла уже
+    # нет, по новому находится тот же узел с тем же содержимым. При изменении
+    # содержимого узла нужно вызвать invalidate.
+    def __init__(self, max_bytes=DEFAULT_CONTENT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, node):
+        text = self.entries.get(node)
+        if text is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(node)
+        self.hits += 1
+        return text
+
+    def put(self, node, text: str):
+        size = sys.getsizeof(text)
+        if size > self.max_bytes:
+            return
+        self.invalidate(node)
+        self.entries[node] = text
+        self.size += size
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= sys.getsizeof(evicted)
+
+    def invalidate(self, node):
+        text = self.entries.pop(node, None)
+        if text is not None:
+            self.size -= sys.getsizeof(text)
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses,
+                "entries": len(self.entries), "bytes": self.size}
+
+
+TEXT_CHUNK_SIZE = 1024 * 1024
+
+_BASE64_SPACE = re.compile(r"\s")
+_BASE64_SPACE_BYTES = re.compile(rb"\s")
+_LINE_BREAKS = re.compile("\r\n|[\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]")
+_NON_ASCII_LINE_BREAKS = re.compile("[\x85\u2028\u2029]")
+
+
+def iter_node_bytes(node: VfsNode, chunk_size: int = TEXT_CHUNK_SIZE):
+    # Содержимое файла кусками байт. base64 декодируется по кратным 4
+    # отрезкам; строка с пробельными символами декодируется целиком.
+    content, raw = node.peek_content()
+    if raw:
+        for start in range(0, len(content), chunk_size):
+            yield content[start:start + chunk_size]
+        return
+    space = _BASE64_SPACE if isinstance(content, str) else _BASE64_SPACE_BYTES
+    if len(content) % 4 or space.search(content):
+        yield base64.b64decode(content)
+        return
+    step = chunk_size // 3 * 4
+    for start in range(0, len(content), step):
+        yield base64.b64decode(content[start:start + step])
+
+
+def iter_node_text(node: VfsNode, chunk_size: int = TEXT_CHUNK_SIZE):
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    for data in iter_node_bytes(node, chunk_size):
+        text = decoder.decode(data)
+        if text:
+            yield text
+    text = decoder.decode(b"", True)
+    if text:
+        yield text
+
+
+def count_text(chunks, count_lines=True, count_words=True,
+               count_bytes=False) -> Tuple[int, int, int, int]:
+    # Один проход по кускам текста с постоянной памятью; результат совпадает
+    # с len(text.splitlines()), len(text.split()), len(text) и длиной текста
+    # в UTF-8 (только при count_bytes, иначе 0)
+    lines = words = chars = size = 0
+    last = ""
+    for chunk in chunks:
+        if not chunk:
+            continue
+        chars += len(chunk)
+        if count_bytes:
+            size += len(chunk) if chunk.isascii() else len(chunk.encode("utf-8", "surrogatepass"))
+        if count_lines:
+            # Кроме "\n" splitlines режет ещё по нескольким символам; поиск
+            # через "in" идёт на скорости memchr, а isascii() — O(1)
+            if ("\r" in chunk or "\x0b" in chunk or "\x0c" in chunk or "\x1c" in chunk
+                    or "\x1d" in chunk or "\x1e" in chunk
+                    or (not chunk.isascii() and _NON_ASCII_LINE_BREAKS.search(chunk))):
+                lines += len(_LINE_BREAKS.findall(chunk))
+            else:
+                lines += chunk.count("\n")
+            # "\r\n" на границе кусков — один перевод строки
+            if last == "\r" and chunk[0] == "\n":
+                lines -= 1
+        if count_words:
+            words += len(chunk.split())
+            # Слово, разрезанное границей кусков, посчитано дважды
+            if last and not last.isspace() and not chunk[0].isspace():
+                words -= 1
+        last = chunk[-1]
+    if count_lines and last and not _LINE_BREAKS.match(last):
+        lines += 1
+    return lines, words, chars, size
+
+
+_LINE_END_CHARS = frozenset("\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029")
+OUTPUT_BATCH_LINES = 4096
+
+
+def _strip_line_end(line: str) -> str:
+    if line.endswith("\r\n"):
+        return line[:-2]
+    if line and line[-1] in _LINE_END_CHARS:
+        return line[:-1]
+    return line
+
+
+def iter_text_lines(chunks):
+    # Строки как у splitlines() поверх кусков текста. Незавершённая строка
+    # копится списком кусков, чтобы длинная строка не склеивалась повторно.
+    pending = []
+    for chunk in chunks:
+        if not chunk:
+            continue
+        if pending and pending[-1].endswith("\r"):
+            # Строка уже закончилась на "\r"; "\n" в начале куска — его пара
+            yield "".join(pending)[:-1]
+            pending = []
+            if chunk[0] == "\n":
+                chunk = chunk[1:]
+                if not chunk:
+                    continue
+        parts = chunk.splitlines(True)
+        for part in parts[:-1]:
+            if pending:
+                pending.append(part)
+                part = "".join(pending)
+                pending = []
+            yield _strip_line_end(part)
+        last = parts[-1]
+        pending.append(last)
+        if last[-1] in _LINE_END_CHARS and last[-1] != "\r":
+            yield _strip_line_end("".join(pending))
+            pending = []
+    if pending:
+        yield _strip_line_end("".join(pending))
+
+
+def iter_uniq_groups(lines, ignore_case=False):
+    # (число повторов, первая строка группы) для подряд идущих одинаковых
+    # строк; в памяти только текущая группа
+    current = key = None
+    count = 0
+    for line in lines:
+        line_key = line.casefold() if ignore_case else line
+        if count and line_key == key:
+            count += 1
+            continue
+        if count:
+            yield count, current
+        current, key, count = line, line_key, 1
+    if count:
+        yield count, current
+
+
+def normalize_path(path: str, cwd: str = "/") -> str:
+    # Абсолютный путь без ".", ".." и повторных "/"
+    path = path.replace("\\", "/")
+    if not path.startswith("/"):
+        path = cwd.rstrip("/") + "/" + path
+    parts = []
+    for part in path.split("/"):
+        if part == "" or part == ".":
+            continue
+        if part == "..":
+            if parts:
+                parts.pop()
+        else:
+            parts.append(part)
+    return "/" + "/".join(parts)
+
+
+def split_path(path: str) -> Tuple[str, str]:
+    # "/a/b/c" -> ("/a/b", "c"), путь должен быть нормализован
+    parent, _, name = path.rpartition("/")
+    return parent or "/", name
+
+
+class VfsIndex:
+    # Индекс "нормализованный абсолютный путь -> узел". Путь попадает в индекс
+    # при первом разрешении вместе со всеми предками, дальше поиск — одно
+    # обращение к словарю. Родитель узла — запись для родительского пути.
+    def __init__(self, root):
+        self.nodes = {"/": root}
+
+    def lookup(self, path: str):
+        node = self.nodes.get(path)
+        if node is not None:
+            return node
+        # Поднимаемся до ближайшего проиндексированного предка
+        missing = []
+        prefix = path
+        while node is None:
+            prefix, _, name = prefix.rpartition("/")
+            missing.append(name)
+            node = self.nodes.get(prefix or "/")
+        for name in reversed(missing):
+            if not node.is_dir:
+                return None
+            node = node.get_children().get(name)
+            if node is None:
+                return None
+            prefix = f"{prefix}/{name}"
+            self.nodes[prefix] = node
+        return node
 
-        self.input_entry.focus_set()
-
-        self.input_entry.bind('<Return>', self.execute_command)
-
-        self.input_entry.bind('<Tab>', self.auto_complete)
+    def parent(self, path: str):
+        return self.lookup(split_path(path)[0])
+
+    def add(self, path: str, node):
+        self.nodes[path] = node
+
+    def discard(self, path: str):
+        # Удаляет путь и все проиндексированные пути под ним. Если путь
+        # директории не в индексе, то и её потомков там нет.
+        node = self.nodes.pop(path, None)
+        stack = [(path, node)] if node is not None else []
+        while stack:
+            dir_path, dir_node = stack.pop()
+            if not dir_node.is_dir or dir_node.flags & NODE_LAZY:
+                # У нераскрытой директории нет проиндексированных потомков
+                continue
+            for name, child in dir_node.children.items():
+                child_path = f"{dir_path}/{name}"
+                if self.nodes.pop(child_path, None) is not None:
+                    stack.append((child_path, child))
+
+
+NAME_INDEX_CACHE_SIZE = 256
+
+
+class NameIndex:
+    # Отсортированные имена детей директорий для поиска по префиксу через
+    # bisect. Список строится при первом обращении к директории и
+    # сбрасывается при её изменении; хранится не больше limit директорий.
+    def __init__(self, limit=NAME_INDEX_CACHE_SIZE):
+        self.limit = limit
+        self.entries = OrderedDict()
+
+    def names(self, node: VfsNode) -> List[str]:
+        names = self.entries.get(node)
+        if names is None:
+            names = sorted(node.get_children())
+            self.entries[node] = names
+            if len(self.entries) > self.limit:
+                self.entries.popitem(last=False)
+        else:
+            self.entries.move_to_end(node)
+        return names
+
+    def matches(self, node: VfsNode, prefix: str) -> List[str]:
+        names = self.names(node)
+        start = bisect.bisect_left(names, prefix)
+        end = start
+        while end < len(names) and names[end].startswith(prefix):
+            end += 1
+        return names[start:end]
+
+    def invalidate(self, node):
+        self.entries.pop(node, None)
+
+    def clear(self):
+        self.entries.clear()
+
+
+TOKEN_CACHE_SIZE = 4096
+
+# Без кавычек и "\\" shlex в режиме posix режет строку только по " \t\r\n"
+_SHLEX_SPECIAL = re.compile(r"[\"'\\]")
+_SIMPLE_TOKEN = re.compile(r"[^ \t\r\n]+")
+
+
+@functools.lru_cache(maxsize=TOKEN_CACHE_SIZE)
+def tokenize(command: str) -> Tuple[str, ...]:
+    # shlex.split с LRU-кэшем по исходной строке; повторы строк скрипта и
+    # истории не разбираются заново. Ошибки (ValueError) не кэшируются.
+    if not _SHLEX_SPECIAL.search(command):
+        return tuple(_SIMPLE_TOKEN.findall(command))
+    return tuple(shlex.split(command))
+
+
+def _unquoted(command: str, chars: str):
+    # Позиции символов из chars вне кавычек и не после "\"; незакрытую
+    # кавычку оставляем shlex, он сообщит об ошибке сам
+    quote = None
+    i = 0
+    while i < len(command):
+        ch = command[i]
+        if quote:
+            if ch == quote:
+                quote = None
+            elif ch == "\\" and quote == '"':
+                i += 1
+        elif ch in "'\"":
+            quote = ch
+        elif ch == "\\":
+            i += 1
+        elif ch in chars:
+            yield i
+        i += 1
+
+
+def split_pipeline(command: str) -> Tuple[str, ...]:
+    if "|" not in command:
+        return (command,)
+    segments = []
+    start = 0
+    for i in _unquoted(command, "|"):
+        segments.append(command[start:i])
+        start = i + 1
+    segments.append(command[start:])
+    return tuple(segments)
+
+
+def split_redirect(command: str) -> Tuple[str, str, str]:
+    # "команда > путь" -> ("команда ", ">", " путь"); режим пустой, если
+    # перенаправления нет. Путь может стоять вплотную: "ls >out", "ls>>out".
+    if ">" in command:
+        for i in _unquoted(command, ">"):
+            if command.startswith(">>", i):
+                return command[:i], ">>", command[i + 2:]
+            return command[:i], ">", command[i + 1:]
+    return command, "", ""
+
+
+def parse_pipeline(command: str):
+    # Конвейер "a | b | c > путь": кортеж токенов каждой команды и
+    # перенаправление (режим, путь) либо None
+    command, mode, target = split_redirect(command)
+    redirect = None
+    if mode:
+        parts = tokenize(target)
+        if len(parts) != 1:
+            raise ValueError(f"после '{mode}' ожидается один путь")
+        redirect = (mode, parts[0])
+    stages = tuple(tokenize(segment) for segment in split_pipeline(command))
+    if len(stages) > 1 and not all(stages):
+        raise ValueError("пустая команда в конвейере")
+    if not stages[0]:
+        if redirect:
+            raise ValueError(f"не указана команда перед '{mode}'")
+        return (), None
+    return stages, redirect
+
+
+class CommandInterrupted(Exception):
+    pass
+
+
+class Command:
+    # Запись реестра команд: обработчик handler(shell, args), строка
+    # аргументов для справки, описание и признак изменения VFS. Команда с
+    # stream(shell, args, stdin) может стоять в конвейере: stdin — итератор
+    # кусков текста или None, результат — такой же итератор.
+    __slots__ = ("name", "handler", "usage", "help", "mutates", "stream")
+
+    def __init__(self, name: str, handler, usage: str = "", help: str = "", mutates: bool = False,
+                 stream=None):
+        self.name = name
+        self.handler = handler
+        self.usage = usage
+        self.help = help
+        self.mutates = mutates
+        self.stream = stream
+
+
+# Общий реестр "имя -> Command" для ShellCore и всех оболочек над ним
+COMMANDS = {}
+
+
+def register_command(name: str, handler=None, usage: str = "", help: str = "", mutates: bool = False,
+                     stream=None):
+    # Регистрирует команду в COMMANDS. Без handler работает как декоратор:
+    #   @register_command("hello", help="поздороваться")
+    #   def cmd_hello(shell, args): ...
+    def decorator(func):
+        COMMANDS[name] = Command(name, func, usage, help, mutates, stream)
+        return func
+    if handler is not None:
+        return decorator(handler)
+    return decorator
+
+
+def commands_help() -> str:
+    entries = [(f"{command.name} {command.usage}".rstrip(), command.help)
+               for command in COMMANDS.values()]
+    width = max(len(spec) for spec, _ in entries) + 2
+    return "".join(f"  {spec.ljust(width)}- {text}\n" for spec, text in entries)
+
+
+PLAN_FORMAT_VERSION = 3
+DEFAULT_PLAN_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+    "shell_emulator", "plans")
+
+
+class PlannedCommand:
+    # Строка скрипта после разбора: имя команды и аргументы, либо текст
+    # ошибки разбора. Обработчик ищется в реестре при выполнении, чтобы
+    # кэшированный план видел команды, зарегистрированные позже. pipe —
+    # следующие команды конвейера, кортеж пар (имя, аргументы); redirect —
+    # пара (">" или ">>", путь).
+    __slots__ = ("line_no", "text", "name", "args", "error", "pipe", "redirect")
+
+    def __init__(self, line_no: int, text: str, name: str, args: Tuple[str, ...], error=None,
+                 pipe=(), redirect=None):
+        self.line_no = line_no
+        self.text = text
+        self.name = name
+        self.args = args
+        self.error = error
+        self.pipe = pipe
+        self.redirect = redirect
+
+
+class ScriptPlan:
+    # Скомпилированный скрипт: команды разобраны один раз. Один план можно
+    # выполнять над разными VFS.
+    def __init__(self, steps: List[PlannedCommand], digest: str = ""):
+        self.steps = steps
+        self.digest = digest
+
+    @property
+    def errors(self) -> List[PlannedCommand]:
+        return [step for step in self.steps if step.error]
+
+    def to_json(self) -> dict:
+        return {
+            "version": PLAN_FORMAT_VERSION,
+            "steps": [[step.line_no, step.text, step.name, list(step.args), step.error,
+                       [[name, list(args)] for name, args in step.pipe],
+                       list(step.redirect) if step.redirect else None]
+                      for step in self.steps]
+        }
+
+    @classmethod
+    def from_json(cls, data: dict, digest: str = ""):
+        if data.get("version") != PLAN_FORMAT_VERSION:
+            raise ValueError("устаревший формат плана")
+        return cls([PlannedCommand(line_no, text, name, tuple(args), error,
+                                   tuple((stage, tuple(stage_args)) for stage, stage_args in pipe),
+                                   tuple(redirect) if redirect else None)
+                    for line_no, text, name, args, error, pipe, redirect in data["steps"]], digest)
+
+
+def compile_script(text: str, digest: str = "") -> ScriptPlan:
+    # Пустые строки и комментарии отбрасываются, ошибки разбора собираются
+    # для всех строк сразу
+    steps = []
+    for line_no, line in enumerate(text.split("\n"), 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            stages, redirect = parse_pipeline(line)
+        except ValueError as e:
+            steps.append(PlannedCommand(line_no, line, "", (), f"Ошибка парсинга: {str(e)}"))
+            continue
+        if stages:
+            pipe = tuple((parts[0], parts[1:]) for parts in stages[1:])
+            steps.append(PlannedCommand(line_no, line, stages[0][0], stages[0][1:],
+                                        pipe=pipe, redirect=redirect))
+    return ScriptPlan(steps, digest)
+
+
+_PLANS = {}
+
+
+def load_script_plan(script_path: str, cache_dir=DEFAULT_PLAN_CACHE_DIR) -> ScriptPlan:
+    # План ищется по sha256 текста скрипта: сначала в памяти процесса, затем
+    # в файле cache_dir/<sha256>.json; иначе скрипт компилируется и план
+    # сохраняется. Недоступный для записи каталог кэша не считается ошибкой.
+    with open(script_path, 'rb') as f:
+        data = f.read()
+    digest = hashlib.sha256(data).hexdigest()
+    plan = _PLANS.get(digest)
+    if plan is not None:
+        return plan
+    cache_path = os.path.join(cache_dir, digest + ".json") if cache_dir else None
+    if cache_path and os.path.isfile(cache_path):
+        try:
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                plan = ScriptPlan.from_json(json.load(f), digest)
+        except (OSError, ValueError, KeyError, TypeError):
+            plan = None
+    if plan is None:
+        # Как при чтении в текстовом режиме: "\r\n" и "\r" считаются "\n"
+        text = data.decode('utf-8').replace("\r\n", "\n").replace("\r", "\n")
+        plan = compile_script(text, digest)
+        if cache_path:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(plan.to_json(), f, ensure_ascii=False)
+                os.replace(tmp_path, cache_path)
+            except OSError:
+                pass
+    _PLANS[digest] = plan
+    return plan
+
+
+class StreamSink:
+    # Вывод в поток: sys.stdout или открытый файл
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text: str):
+        self.stream.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+class QueueSink:
+    # Приёмник для рабочего потока: виджеты Tk можно трогать только из
+    # главного потока, поэтому вывод передаётся через потокобезопасную очередь
+    def __init__(self, output_queue):
+        self.queue = output_queue
+
+    def write(self, text: str):
+        if text:
+            self.queue.put(("out", text))
+
+    def flush(self):
+        pass
 
-        self.command_history = []
-        self.history_index = -1
 
-        self.input_entry.bind('<Up>', self.navigate_history_up)
-        self.input_entry.bind('<Down>', self.navigate_history_down)
+class BufferSink:
+    # Вывод в память, удобно для тестов и повторного прогона скриптов
+    def __init__(self):
+        self.parts = []
 
-        self.print_output(f"[DEBUG] VFS Path: {self.vfs_path}\n")
-        self.print_output(f"[DEBUG] Startup Script: {self.startup_script}\n")
+    def write(self, text: str):
+        self.parts.append(text)
 
-        if self.startup_script:
-            self.run_startup_script(self.startup_script)
+    def flush(self):
+        pass
 
-    def get_window_title(self) -> str:
-        username = getpass.getuser()
-        hostname = platform.node()
-        return f"Эмулятор - [{username}@{hostname}]"
+    def getvalue(self) -> str:
+        return "".join(self.parts)
+
+    def clear(self):
+        self.parts = []
+
+
+DEFAULT_SCROLLBACK = 1000000
+SCRIPT_POLL_MS = 30
+OUTPUT_VIEW_MARGIN = 200
+OUTPUT_RENDER_LINE_LIMIT = 4096
+OUTPUT_WHEEL_LINES = 3
+SEARCH_BLOCK_LINES = 4096
+SEARCH_CACHE_BLOCKS = 16
+SEARCH_SLICE_MS = 15
+COMPLETION_LIST_LIMIT = 200
+DEFAULT_HISTORY_SIZE = 10000
+DEFAULT_HISTORY_PATH = os.path.join(os.path.expanduser("~"), ".shell_emulator_history")
+
+
+_NEWLINE = re.compile(b"\n")
+
+
+class LineStore:
+    # Компактное хранилище строк вывода: текст в UTF-8 одним bytearray и
+    # массив смещений начал строк. Номера строк и смещения сквозные: после
+    # drop_head первой остаётся строка first, а data начинается со смещения
+    # shift. Последняя строка — незавершённая (после последнего "\n") и
+    # может быть пустой.
+    def __init__(self):
+        self.data = bytearray()
+        self.starts = array("Q", [0])
+        self.first = 0
+        self.shift = 0
+
+    def __len__(self):
+        return len(self.starts)
+
+    @property
+    def end(self) -> int:
+        return self.first + len(self.starts)
+
+    def append(self, text: str):
+        base = self.shift + len(self.data)
+        raw = text.encode("utf-8", "replace")
+        self.data += raw
+        self.starts.extend(base + match.end() for match in _NEWLINE.finditer(raw))
+
+    def span(self, number: int) -> Tuple[int, int]:
+        # Смещения строки в data без завершающего "\n"
+        index = number - self.first
+        if index + 1 < len(self.starts):
+            return self.starts[index] - self.shift, self.starts[index + 1] - 1 - self.shift
+        return self.starts[index] - self.shift, len(self.data)
+
+    def line(self, number: int) -> str:
+        start, stop = self.span(number)
+        return self.data[start:stop].decode("utf-8", "replace")
+
+    def lines(self, start: int, stop: int) -> List[str]:
+        # Строки [start, stop) одним декодированием среза
+        start = max(start, self.first)
+        stop = min(stop, self.end)
+        if start >= stop:
+            return []
+        return self.data[self.span(start)[0]:self.span(stop - 1)[1]].decode("utf-8", "replace").split("\n")
+
+    def drop_head(self, count: int) -> bytes:
+        # Срезает count первых строк и возвращает их текст с переводами строк
+        count = min(count, len(self.starts) - 1)
+        cut = self.starts[count] - self.shift
+        dropped = bytes(self.data[:cut])
+        del self.data[:cut]
+        del self.starts[:count]
+        self.first += count
+        self.shift += cut
+        return dropped
+
+
+class Scrollback:
+    # Буфер логических строк вывода поверх LineStore. При переполнении старые
+    # строки срезаются пачкой (с запасом в десятую часть лимита), а если задан
+    # spill_path, дописываются в файл и остаются доступными для прокрутки и
+    # поиска: spill_starts — смещения начал вытесненных строк в файле.
+    # Строки, оставшиеся в файле от прошлых сеансов, в нумерацию не входят.
+    def __init__(self, limit=None, spill_path=None):
+        self.limit = limit or None
+        self.store = LineStore()
+        self.spill_path = spill_path
+        self.spill = None
+        self.spill_reader = None
+        self.spill_starts = array("Q")
+        if spill_path:
+            self.spill = open(spill_path, "ab")
+            self.spill_starts.append(self.spill.tell())
+
+    @property
+    def first(self) -> int:
+        return 0 if self.spill else self.store.first
+
+    @property
+    def end(self) -> int:
+        return self.store.end
+
+    def append(self, text: str):
+        self.store.append(text)
+        complete = len(self.store) - 1
+        if self.limit and complete > self.limit + max(self.limit // 10, 1):
+            dropped = self.store.drop_head(complete - self.limit)
+            if self.spill:
+                base = self.spill_starts[-1]
+                self.spill.write(dropped)
+                self.spill_starts.extend(base + match.end() for match in _NEWLINE.finditer(dropped))
+
+    def lines(self, start: int, stop: int) -> List[str]:
+        # Строки [start, stop): вытесненные читаются из файла, остальные —
+        # из памяти
+        start = max(start, self.first)
+        stop = min(stop, self.end)
+        if start >= stop:
+            return []
+        lines = []
+        if start < self.store.first:
+            spilled_stop = min(stop, self.store.first)
+            if self.spill_reader is None:
+                self.spill_reader = open(self.spill_path, "rb")
+            self.spill.flush()
+            self.spill_reader.seek(self.spill_starts[start])
+            data = self.spill_reader.read(self.spill_starts[spilled_stop] - 1 - self.spill_starts[start])
+            lines = data.decode("utf-8", "replace").split("\n")
+            start = spilled_stop
+        if start < stop:
+            lines += self.store.lines(start, stop)
+        return lines
+
+    def close(self):
+        if self.spill_reader:
+            self.spill_reader.close()
+            self.spill_reader = None
+        if self.spill:
+            self.spill.close()
+            self.spill = None
+
+
+class CommandHistory:
+    # История команд без повторов: повторённая команда переносится в конец.
+    # Хранится не больше limit команд; файл только дописывается и читается
+    # при первом обращении, а когда в нём вдвое больше строк, чем limit,
+    # переписывается без повторов. Индекс поиска — все команды одним текстом
+    # через "\n" и таблица смещений: подстрока ищется str.rfind со скоростью
+    # C, команда по смещению находится через bisect.
+    def __init__(self, path=None, limit=DEFAULT_HISTORY_SIZE):
+        self.path = path
+        self.limit = limit
+        self.loaded = False
+        # Команды от старых к новым (значения не используются)
+        self.commands = OrderedDict()
+        self.file_lines = 0
+        # Список команд и индекс поиска строятся при обращении
+        self.list = None
+        self.text = None
+        self.offsets = None
+        self.positions = None
+
+    def load(self):
+        if self.loaded:
+            return
+        self.loaded = True
+        if not self.path or not os.path.isfile(self.path):
+            return
+        # Строки, дописанные add до загрузки, уже в файле и считаются здесь
+        self.file_lines = 0
+        try:
+            with open(self.path, "r", encoding="utf-8", errors="replace") as f:
+                for line in f:
+                    self.file_lines += 1
+                    self.remember(line.rstrip("\n"))
+        except OSError:
+            return
+        if self.file_lines > 2 * self.limit:
+            self.compact()
 
-    def create_widgets(self):
-        main_frame = tk.Frame(self.root)
-        main_frame.pack(fill=tk.BOTH, expand=True, padx=2, pady=2)
+    def remember(self, command: str):
+        if not command:
+            return
+        if command in self.commands:
+            self.commands.move_to_end(command)
+        else:
+            self.commands[command] = None
+            if len(self.commands) > self.limit:
+                self.commands.popitem(last=False)
+        self.list = None
+        self.text = None
+
+    def add(self, command: str):
+        command = command.replace("\n", " ").strip()
+        if not command:
+            return
+        if self.path:
+            try:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(command + "\n")
+                self.file_lines += 1
+            except OSError:
+                pass
+            else:
+                # Не загруженная история прочтёт команду из файла
+                if self.loaded:
+                    self.remember(command)
+                    if self.file_lines > 2 * self.limit:
+                        self.compact()
+                return
+        # Файла нет или запись не удалась: команда остаётся только в памяти,
+        # поэтому история загружается сейчас, чтобы сохранить порядок
+        self.load()
+        self.remember(command)
 
-        self.output_text = scrolledtext.ScrolledText(
-            main_frame,
+    def compact(self):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.writelines(command + "\n" for command in self.commands)
+            os.replace(tmp_path, self.path)
+            self.file_lines = len(self.commands)
+        except OSError:
+            pass
+
+    def items(self) -> List[str]:
+        # Команды от старых к новым
+        self.load()
+        if self.list is None:
+            self.list = list(self.commands)
+        return self.list
+
+    def __len__(self) -> int:
+        self.load()
+        return len(self.commands)
+
+    def search(self, query: str, older_than=None):
+        # Самая новая команда с подстрокой query, введённая раньше команды
+        # older_than (предыдущего результата поиска); None, если такой нет
+        items = self.items()
+        if self.text is None:
+            self.text = "\n".join(items)
+            self.offsets = []
+            position = 0
+            for command in items:
+                self.offsets.append(position)
+                position += len(command) + 1
+            self.positions = {command: index for index, command in enumerate(items)}
+        end = len(self.text)
+        if older_than is not None and older_than in self.positions:
+            end = self.offsets[self.positions[older_than]]
+        # В командах и запросе нет "\n", поэтому совпадение не выходит за
+        # границы одной команды
+        hit = self.text.rfind(query.replace("\n", " "), 0, end)
+        if hit < 0:
+            return None
+        return items[bisect.bisect_right(self.offsets, hit) - 1]
+
+
+class OutputSearch:
+    # Поиск по выводу, включая вытесненные в файл строки. Строки разбиты на
+    # блоки по SEARCH_BLOCK_LINES со сквозной нумерацией; заполненный блок
+    # больше не меняется, поэтому число совпадений в нём считается один раз,
+    # и после роста вывода просматриваются только новые строки. Сами
+    # совпадения (строка, начало, конец) держатся для нескольких последних
+    # блоков и пересчитываются по требованию.
+    def __init__(self, scrollback, query: str, regex=False, ignore_case=False):
+        # Ошибка в регулярном выражении выходит наружу как re.error;
+        # ^ и $ относятся к строкам вывода
+        self.scrollback = scrollback
+        self.pattern = re.compile(query if regex else re.escape(query),
+                                  re.MULTILINE | (re.IGNORECASE if ignore_case else 0))
+        self.counts = {}
+        self.cache = OrderedDict()
+        self.scanned = 0
+
+    def block_text(self, block: int) -> Tuple[int, List[str]]:
+        start = max(block * SEARCH_BLOCK_LINES, self.scrollback.first)
+        return start, self.scrollback.lines(start, (block + 1) * SEARCH_BLOCK_LINES)
+
+    def complete(self, block: int) -> bool:
+        # Последняя строка хранилища ещё дописывается
+        return (block + 1) * SEARCH_BLOCK_LINES < self.scrollback.end
+
+    def matches(self, block: int) -> List[Tuple[int, int, int]]:
+        cached = self.cache.get(block)
+        if cached is not None:
+            self.cache.move_to_end(block)
+            return cached
+        start, lines = self.block_text(block)
+        offsets = list(itertools.accumulate((len(line) + 1 for line in lines), initial=0))
+        found = []
+        for match in self.pattern.finditer("\n".join(lines)):
+            if match.end() > match.start():
+                index = bisect.bisect_right(offsets, match.start()) - 1
+                found.append((start + index, match.start() - offsets[index], match.end() - offsets[index]))
+        if self.complete(block):
+            self.counts[block] = len(found)
+            self.cache[block] = found
+            if len(self.cache) > SEARCH_CACHE_BLOCKS:
+                self.cache.popitem(last=False)
+        return found
+
+    def live_matches(self, block: int) -> List[Tuple[int, int, int]]:
+        # Без строк, срезанных из буфера после подсчёта
+        return [match for match in self.matches(block) if match[0] >= self.scrollback.first]
+
+    def count_block(self, block: int) -> int:
+        count = self.counts.get(block)
+        if count is None:
+            _, lines = self.block_text(block)
+            count = sum(1 for match in self.pattern.finditer("\n".join(lines)) if match.end() > match.start())
+            if self.complete(block):
+                self.counts[block] = count
+        return count
+
+    def scan(self, budget: float) -> bool:
+        # Считает совпадения в ещё не просмотренных блоках, пока не истечёт
+        # budget секунд; True — просмотрен весь вывод
+        started = time.perf_counter()
+        first_block = self.scrollback.first // SEARCH_BLOCK_LINES
+        for block in [block for block in self.counts if block < first_block]:
+            del self.counts[block]
+        self.scanned = max(self.scanned, first_block)
+        while self.complete(self.scanned):
+            self.count_block(self.scanned)
+            self.scanned += 1
+            if time.perf_counter() - started > budget:
+                return False
+        return True
+
+    def total(self) -> int:
+        # Блок, из которого срезана часть строк, и дописываемый блок
+        # пересчитываются
+        first_block = self.scrollback.first // SEARCH_BLOCK_LINES
+        last_block = (self.scrollback.end - 1) // SEARCH_BLOCK_LINES
+        total = sum(count for block, count in self.counts.items() if first_block < block < last_block)
+        total += len(self.live_matches(first_block))
+        if last_block != first_block:
+            total += len(self.live_matches(last_block))
+        return total
+
+    def rank(self, match) -> int:
+        # Порядковый номер совпадения среди всех, с 1
+        block = match[0] // SEARCH_BLOCK_LINES
+        first_block = self.scrollback.first // SEARCH_BLOCK_LINES
+        before = sum(self.count_block(other) if other != first_block else len(self.live_matches(other))
+                     for other in range(first_block, block))
+        return before + self.live_matches(block).index(match) + 1
+
+    def next(self, position: Tuple[int, int], backwards=False):
+        # Ближайшее совпадение после position = (строка, столбец) или перед
+        # ним, по кругу; None, если совпадений нет
+        first_block = self.scrollback.first // SEARCH_BLOCK_LINES
+        blocks = (self.scrollback.end - 1) // SEARCH_BLOCK_LINES - first_block + 1
+        origin = min(max(position[0] // SEARCH_BLOCK_LINES - first_block, 0), blocks - 1)
+        for step in range(blocks + 1):
+            block = first_block + (origin + (-step if backwards else step)) % blocks
+            if self.counts.get(block) == 0 and block != first_block:
+                continue
+            found = self.live_matches(block)
+            if step == 0:
+                found = [match for match in found
+                         if (match[:2] < position if backwards else match[:2] > position)]
+            if found:
+                return found[-1] if backwards else found[0]
+        return None
+
+    def in_range(self, start: int, stop: int) -> List[Tuple[int, int, int]]:
+        found = []
+        for block in range(start // SEARCH_BLOCK_LINES, (stop - 1) // SEARCH_BLOCK_LINES + 1):
+            found.extend(match for match in self.matches(block) if start <= match[0] < stop)
+        return found
+
+
+class TextWidgetSink:
+    # Записи копятся в буфере и попадают в панель вывода одной вставкой за
+    # кадр (after_idle)
+    def __init__(self, view):
+        self.view = view
+        self.pending = []
+        self.flush_scheduled = False
+
+    def write(self, text: str):
+        if not text:
+            return
+        self.pending.append(text)
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.view.text.after_idle(self.flush)
+
+    def flush(self):
+        self.flush_scheduled = False
+        if not self.pending:
+            return
+        text = "".join(self.pending)
+        self.pending = []
+        self.view.append(text)
+
+
+class OutputView:
+    # Виртуализированная панель вывода: весь текст живёт в буфере прокрутки
+    # (LineStore и файл вытесненных строк), а в Text вставляются только видимые строки и margin строк
+    # сверху и снизу. Прокрутку панель ведёт сама в номерах строк, поэтому
+    # отрисовка стоит O(высоты окна) при любом объёме вывода.
+    def __init__(self, parent, scrollback, text_font, margin=OUTPUT_VIEW_MARGIN):
+        self.scrollback = scrollback
+        self.margin = margin
+        self.line_height = max(1, text_font.metrics("linespace"))
+        # top — первая видимая строка; follow — держать в окне конец вывода;
+        # rendered — диапазон строк, вставленных в Text; marked — строка,
+        # найденная переходом; search и current — активный поиск и текущее
+        # совпадение; on_append вызывается после каждого дописывания
+        self.top = 0
+        self.follow = True
+        self.rendered = (0, 0)
+        self.marked = None
+        self.search = None
+        self.current = None
+        self.on_append = None
+
+        self.frame = tk.Frame(parent, bg='black')
+        self.frame.pack(fill=tk.BOTH, expand=True)
+        self.scrollbar = tk.Scrollbar(self.frame, command=self.yview)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.text = tk.Text(
+            self.frame,
             wrap=tk.WORD,
-            font=self.terminal_font,
+            font=text_font,
             bg='black',
             fg='white',
             insertbackground='white',
             state='disabled'
         )
-        self.output_text.pack(fill=tk.BOTH, expand=True)
-
-        input_frame = tk.Frame(main_frame, bg='black')
-        input_frame.pack(fill=tk.X, pady=(2, 0))
-
-        self.prompt_label = tk.Label(
-            input_frame,
-            text=self.get_prompt(),
-            font=self.terminal_font,
-            bg='black',
-            fg='green',
-            anchor='w'
-        )
-        self.prompt_label.pack(side=tk.LEFT)
+        self.text.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.text.tag_configure('marked', background='#404000')
+        self.text.tag_configure('found', background='#505050')
+        self.text.tag_configure('current', background='#a06000')
+
+        self.text.bind('<Configure>', lambda event: self.render())
+        self.text.bind('<MouseWheel>', self.on_wheel)
+        self.text.bind('<Button-4>', self.on_wheel)
+        self.text.bind('<Button-5>', self.on_wheel)
+        self.text.bind('<Prior>', lambda event: self.yview("scroll", -1, "pages") or "break")
+        self.text.bind('<Next>', lambda event: self.yview("scroll", 1, "pages") or "break")
+        self.text.bind('<Control-Home>', lambda event: self.scroll_to(self.scrollback.first) or "break")
+        self.text.bind('<Control-End>', lambda event: self.scroll_to(self.scrollback.end) or "break")
+
+    def visible(self) -> int:
+        return max(1, self.text.winfo_height() // self.line_height)
+
+    def bottom(self) -> int:
+        return max(self.scrollback.first, self.scrollback.end - self.visible())
+
+    def append(self, text: str):
+        # Изменилась последняя строка: если она отрисована, окно обновляется
+        tail_shown = self.rendered[1] >= self.scrollback.end
+        self.scrollback.append(text)
+        self.render(force=tail_shown)
+        if self.on_append is not None:
+            self.on_append()
+
+    def scroll_to(self, top: int, force=False):
+        self.top = min(max(top, self.scrollback.first), self.bottom())
+        self.follow = self.top >= self.bottom()
+        self.render(force)
+
+    def render(self, force=False):
+        source = self.scrollback
+        visible = self.visible()
+        if self.follow:
+            self.top = self.bottom()
+        self.top = max(self.top, source.first)
+        start, stop = self.rendered
+        # Перерисовка нужна, только если видимые строки вышли за отрисованный
+        # диапазон; прокрутка внутри запаса сдвигает Text без вставки
+        if force or start < source.first or self.top < start or min(self.top + visible, source.end) > stop:
+            start = max(source.first, self.top - self.margin)
+            stop = min(source.end, self.top + visible + self.margin)
+            lines = [line if len(line) <= OUTPUT_RENDER_LINE_LIMIT
+                     else line[:OUTPUT_RENDER_LINE_LIMIT] + "…"
+                     for line in source.lines(start, stop)]
+            self.text.config(state='normal')
+            self.text.delete('1.0', tk.END)
+            self.text.insert('1.0', "\n".join(lines))
+            self.text.config(state='disabled')
+            self.rendered = (start, stop)
+            if self.marked is not None and start <= self.marked < stop:
+                row = self.marked - start + 1
+                self.text.tag_add('marked', f'{row}.0', f'{row}.end')
+            if self.search is not None:
+                for match in self.search.in_range(start, stop):
+                    row = match[0] - start + 1
+                    tag = 'current' if match == self.current else 'found'
+                    self.text.tag_add(tag, f'{row}.{match[1]}', f'{row}.{match[2]}')
+        if self.follow:
+            self.text.see(tk.END)
+        else:
+            self.text.yview(f'{self.top - start + 1}.0')
+        total = max(1, source.end - source.first)
+        self.scrollbar.set((self.top - source.first) / total,
+                           min(1.0, (self.top - source.first + visible) / total))
+
+    def yview(self, *args):
+        # Команды полосы прокрутки: moveto доля, scroll n units|pages
+        if args[0] == "moveto":
+            self.scroll_to(self.scrollback.first + int(float(args[1]) * (self.scrollback.end - self.scrollback.first)))
+        elif args[0] == "scroll":
+            step = int(args[1]) * (self.visible() if args[2] == "pages" else 1)
+            self.scroll_to(self.top + step)
+
+    def on_wheel(self, event):
+        up = event.num == 4 or getattr(event, 'delta', 0) > 0
+        self.scroll_to(self.top + (-OUTPUT_WHEEL_LINES if up else OUTPUT_WHEEL_LINES))
+        return "break"
 
-        self.input_entry = tk.Entry(
-            input_frame,
-            font=self.terminal_font,
+    def show_line(self, number: int):
+        # Найденная строка выделяется и ставится в середину окна
+        number = min(max(number, self.scrollback.first), self.scrollback.end - 1)
+        self.marked = number
+        self.scroll_to(number - self.visible() // 2, force=True)
+
+    def set_search(self, search):
+        self.search = search
+        self.current = None
+        self.render(force=True)
+
+    def show_match(self, match):
+        self.current = match
+        self.marked = None
+        self.scroll_to(match[0] - self.visible() // 2, force=True)
+
+
+class FindBar:
+    # Панель поиска по выводу (Ctrl+F): запрос ищется по мере ввода,
+    # Enter / Shift+Enter и F3 / Shift+F3 — следующее и предыдущее
+    # совпадение, Escape закрывает. Совпадения подсвечиваются в видимой части;
+    # общее число считается порциями по таймеру, чтобы окно не замирало на
+    # больших объёмах вывода.
+    def __init__(self, view, text_font):
+        self.view = view
+        self.search = None
+        self.options = None
+        self.scan_scheduled = False
+        self.scan_done = False
+
+        self.frame = tk.Frame(view.frame, bg='black')
+        self.regex = tk.BooleanVar(value=False)
+        self.ignore_case = tk.BooleanVar(value=False)
+        tk.Label(self.frame, text="Найти:", font=text_font, bg='black', fg='white').pack(side=tk.LEFT)
+        self.entry = tk.Entry(
+            self.frame,
+            font=text_font,
             bg='black',
             fg='white',
             insertbackground='white',
             relief=tk.FLAT
         )
-        self.input_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(2, 0))
+        self.entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(2, 0))
+        for text, variable in (("regex", self.regex), ("без регистра", self.ignore_case)):
+            tk.Checkbutton(self.frame, text=text, variable=variable, command=self.update,
+                           bg='black', fg='white', selectcolor='black',
+                           activebackground='black', activeforeground='white').pack(side=tk.LEFT)
+        for text, backwards in (("▲", True), ("▼", False)):
+            tk.Button(self.frame, text=text, command=lambda backwards=backwards: self.find_next(backwards),
+                      bg='black', fg='white', relief=tk.FLAT).pack(side=tk.LEFT)
+        self.status = tk.Label(self.frame, font=text_font, bg='black', fg='gray', width=24, anchor='e')
+        self.status.pack(side=tk.LEFT)
+
+        self.entry.bind('<Return>', lambda event: self.find_next(False))
+        self.entry.bind('<Shift-Return>', lambda event: self.find_next(True))
+        self.entry.bind('<Escape>', self.close)
+        self.entry.bind('<KeyRelease>', self.update)
+
+    def open(self, event=None):
+        if not self.frame.winfo_ismapped():
+            self.frame.pack(side=tk.BOTTOM, fill=tk.X, before=self.view.scrollbar)
+        self.entry.focus_set()
+        self.entry.select_range(0, tk.END)
+        return "break"
 
-    def get_prompt(self) -> str:
-        username = os.getlogin()
-        hostname = os.uname().nodename if hasattr(os, 'uname') else 'localhost'
-        current_dir = self.current_dir.strip("/") or "/"
-        return f"{username}@{hostname}:{current_dir}$ "
+    def close(self, event=None):
+        self.frame.pack_forget()
+        self.search = None
+        self.options = None
+        self.view.on_append = None
+        self.view.set_search(None)
+        return "break"
 
-    def welcome_message(self):
-        welcome_text = """Добро пожаловать в эмулятор терминала!
-Доступные команды:
-  ls [аргументы]    - список файлов 
-  cd [директория]   - сменить директорию
-  wc [файл]         - подсчитать строки, слова и символы в файле
-  uniq [файл]       - вывести уникальные строки файла
-  mv [источник] [цель] - переместить или переименовать файл/директорию
-  exit              - выход из эмулятора
+    def update(self, event=None):
+        # True — запрос изменился и панель уже перешла к первому совпадению
+        options = (self.entry.get(), self.regex.get(), self.ignore_case.get())
+        if options == self.options:
+            return None
+        self.options = options
+        self.entry.config(fg='white')
+        if not options[0]:
+            self.search = None
+            self.view.set_search(None)
+            self.status.config(text="")
+            return None
+        try:
+            self.search = OutputSearch(self.view.scrollback, *options)
+        except re.error as e:
+            self.search = None
+            self.view.set_search(None)
+            self.entry.config(fg='red')
+            self.status.config(text=f"ошибка: {e}")
+            return None
+        self.view.on_append = self.schedule_scan
+        self.view.set_search(self.search)
+        self.scan_done = False
+        self.find_next(False, (self.view.top, -1))
+        self.schedule_scan()
+        return True
+
+    def find_next(self, backwards=False, position=None):
+        if position is None and self.update():
+            return "break"
+        if self.search is None:
+            return "break"
+        if position is None:
+            current = self.view.current
+            position = current[:2] if current is not None else (self.view.top, -1)
+        match = self.search.next(position, backwards)
+        if match is None:
+            self.entry.bell()
+        else:
+            self.view.show_match(match)
+        self.show_status()
+        return "break"
 
-Попробуйте ввести команды с аргументами в кавычках!
-"""
-        self.print_output(welcome_text)
+    def schedule_scan(self):
+        self.scan_done = False
+        if not self.scan_scheduled and self.search is not None:
+            self.scan_scheduled = True
+            self.entry.after(SEARCH_SLICE_MS, self.scan_step)
 
-    def print_output(self, text: str):
-        self.output_text.config(state='normal')
-        self.output_text.insert(tk.END, text)
-        self.output_text.see(tk.END)
-        self.output_text.config(state='disabled')
+    def scan_step(self):
+        self.scan_scheduled = False
+        if self.search is None:
+            return
+        self.scan_done = self.search.scan(SEARCH_SLICE_MS / 1000)
+        self.show_status()
+        if not self.scan_done:
+            self.schedule_scan()
 
-    def update_prompt(self):
-        self.prompt_label.config(text=self.get_prompt())
+    def show_status(self):
+        if self.search is None:
+            return
+        if not self.scan_done:
+            self.status.config(text="поиск...")
+            return
+        total = self.search.total()
+        current = self.view.current
+        if not total:
+            self.status.config(text="нет совпадений")
+        elif current is not None and current[0] >= self.view.scrollback.first:
+            self.status.config(text=f"{self.search.rank(current)} из {total}")
+        else:
+            self.status.config(text=f"совпадений: {total}")
 
-    def parse_command(self, command: str) -> Tuple[str, List[str]]:
-        try:
-            parts = shlex.split(command)
-            if not parts:
-                return "", []
-            cmd = parts[0]
-            args = parts[1:]
-            return cmd, args
-        except ValueError as e:
-            raise Exception(f"Ошибка парсинга: {str(e)}")
 
-    def execute_command(self, event=None):
-        command = self.input_entry.get().strip()
+@functools.lru_cache(maxsize=None)
+def user_name() -> str:
+    # Пользователь и хост определяются один раз на процесс
+    try:
+        return os.getlogin()
+    except OSError:
+        # Нет управляющего терминала (CI, сервер, перенаправленный stdin)
+        pass
+    try:
+        return getpass.getuser()
+    except (KeyError, OSError):
+        # В контейнере у uid может не быть записи в passwd
+        return "user"
+
+
+@functools.lru_cache(maxsize=None)
+def host_name() -> str:
+    if hasattr(os, 'uname'):
+        return os.uname().nodename
+    return platform.node() or 'localhost'
+
+
+def _prompt_dir(current_dir: str) -> str:
+    return current_dir.strip("/") or "/"
+
+
+def _prompt_basename(current_dir: str) -> str:
+    return current_dir.rsplit("/", 1)[1] or "/"
+
+
+DEFAULT_PS1 = "\\u@\\H:\\w\\$ "
+_PROMPT_ESCAPES = {
+    "u": user_name,
+    "h": lambda: host_name().split(".")[0],
+    "H": host_name,
+    "$": lambda: "$",
+    "\\": lambda: "\\",
+}
+
+
+class PromptTemplate:
+    # Приглашение в формате PS1: \u — пользователь, \h — имя хоста до первой
+    # точки, \H — полное имя хоста, \w — текущая директория, \W — её последний
+    # компонент, \$ — "$", \\ — обратная косая черта. Всё, кроме директории,
+    # подставляется один раз при разборе; пользователь и хост запрашиваются
+    # у системы, только если они есть в формате.
+    def __init__(self, fmt: str = DEFAULT_PS1):
+        self.format = fmt
+        # Готовые строки и функции директории вперемешку
+        self.parts = []
+        literal = []
+        i = 0
+        while i < len(fmt):
+            code = fmt[i + 1] if fmt[i] == "\\" and i + 1 < len(fmt) else ""
+            if code in ("w", "W"):
+                self.parts.append("".join(literal))
+                self.parts.append(_prompt_dir if code == "w" else _prompt_basename)
+                literal = []
+            elif code in _PROMPT_ESCAPES:
+                literal.append(_PROMPT_ESCAPES[code]())
+            else:
+                literal.append(fmt[i:i + 2] if code else fmt[i])
+            i += 2 if code else 1
+        self.parts.append("".join(literal))
+        self.parts = [part for part in self.parts if part != ""]
+        self.last_dir = None
+        self.last_text = ""
+
+    def render(self, current_dir: str) -> str:
+        if current_dir != self.last_dir:
+            self.last_text = "".join(part if part.__class__ is str else part(current_dir)
+                                     for part in self.parts)
+            self.last_dir = current_dir
+        return self.last_text
+
+
+class VfsSnapshot:
+    # Снимок VFS: корень дерева, источник ленивого содержимого и текущая
+    # директория. Узлы снимка не меняются: ядро копирует их перед записью.
+    __slots__ = ("root", "source", "current_dir")
+
+    def __init__(self, root: VfsNode, source, current_dir: str):
+        self.root = root
+        self.source = source
+        self.current_dir = current_dir
 
-        if not command:
-            self.input_entry.delete(0, tk.END)
-            return
 
-        self.command_history.append(command)
-        self.history_index = len(self.command_history)
+class ShellCore:
+    # Ядро эмулятора: VFS, текущая директория и команды. Ничего не знает о Tk,
+    # весь вывод идёт в sink с методами write/flush.
+    def __init__(self, vfs_path=None, startup_script=None, sink=None, lazy_vfs=False,
+                 cache_bytes=DEFAULT_CONTENT_CACHE_BYTES, plan_cache_dir=DEFAULT_PLAN_CACHE_DIR,
+                 autosave=False, ps1=None):
+        self.vfs_path = vfs_path
 
-        self.print_output(f"{self.get_prompt()}{command}\n")
+        self.init_prompt(ps1)
 
-        try:
-            cmd, args = self.parse_command(command)
+        # С autosave каждое изменение VFS сразу пишется в журнал
+        self.autosave = autosave
+
+        self.journal = None
+
+        # Эпоха копирования при записи: узлы с меньшей эпохой принадлежат
+        # снимкам и перед изменением копируются вместе с предками
+        self.epoch = 0
+
+        self.snapshots = {}
+
+        self.name_index = NameIndex()
+
+        self.plan_cache_dir = plan_cache_dir
+
+        self.content_cache = ContentCache(cache_bytes)
+
+        self.lazy_vfs = lazy_vfs
+
+        self.vfs_source = None
+
+        self.startup_script = startup_script
 
-            if cmd == "exit":
-                self.root.quit()
+        self.sink = sink if sink is not None else StreamSink(sys.stdout)
 
-            elif cmd == "ls":
-                self.cmd_ls(args)
+        self.running = True
 
-            elif cmd == "cd":
-                self.cmd_cd(args)
+        # Запрос прерывания (Ctrl+C); проверяется между командами скрипта и
+        # между кусками потокового чтения файла
+        self.interrupted = False
 
-            elif cmd == "wc":
-                self.cmd_wc(args)
+        # Куда писать ошибки, пока self.sink перехвачен конвейером
+        self.error_sink = None
 
-            elif cmd == "uniq":
-                self.cmd_uniq(args)
+        # Число сообщений об ошибках; по нему пакетный режим определяет
+        # статус скрипта
+        self.error_count = 0
 
-            elif cmd == "mv":
-                self.cmd_mv(args)
+        self.set_vfs(empty_vfs())
+        if self.vfs_path:
+            self.load_vfs(self.vfs_path)
+        else:
+            self.set_vfs(node_from_json(default_vfs()))
+
+    def init_prompt(self, ps1=None):
+        # Текущая директория и формат приглашения: аргумент, затем
+        # EMULATOR_PS1, затем DEFAULT_PS1. Графической оболочке они нужны до
+        # создания виджетов, то есть до ShellCore.__init__.
+        self.current_dir = "/"
+        self.prompt = PromptTemplate(ps1 or os.environ.get("EMULATOR_PS1") or DEFAULT_PS1)
+
+    def get_prompt(self) -> str:
+        return self.prompt.render(self.current_dir)
+
+    def print_output(self, text: str):
+        self.sink.write(text)
+
+    def print_error(self, text: str):
+        # Сообщения об ошибках идут на терминал, даже когда вывод команды
+        # перехвачен конвейером
+        self.error_count += 1
+        (self.error_sink or self.sink).write(text)
+
+    def write_stream(self, chunks):
+        for chunk in chunks:
+            self.print_output(chunk)
+
+    def update_prompt(self):
+        pass
+
+    def on_script_progress(self, done: int, total: int):
+        pass
+
+    def exit(self):
+        self.running = False
 
-            elif cmd:
-                self.print_output(f"Команда '{cmd}' не найдена\n")
+    def parse_pipeline(self, command: str):
+        try:
+            stages, redirect = parse_pipeline(command)
+            return [(parts[0], list(parts[1:])) for parts in stages], redirect
+        except ValueError as e:
+            raise Exception(f"Ошибка парсинга: {str(e)}")
 
+    def run_startup_script(self, script_path):
+        if not os.path.isfile(script_path):
+            self.print_error(f"Ошибка: стартовый скрипт '{script_path}' не найден\n")
+            return
+        try:
+            plan = load_script_plan(script_path, self.plan_cache_dir)
         except Exception as e:
-            self.print_output(f"Ошибка: {str(e)}\n")
+            self.print_error(f"Ошибка при чтении скрипта: {str(e)}\n")
+            return
+        self.run_plan(plan)
+
+    def run_plan(self, plan: ScriptPlan):
+        # Все ошибки разбора сообщаются один раз до выполнения; строки с
+        # ошибкой затем молча пропускаются, остальные выполняются без
+        # повторного разбора
+        for step in plan.errors:
+            self.print_error(f"[Ошибка в скрипте] строка {step.line_no}: {step.error}\n")
+        total = len(plan.steps)
+        for done, step in enumerate(plan.steps):
+            if not self.running or self.interrupted:
+                break
+            self.on_script_progress(done, total)
+            if step.error:
+                continue
+            self.print_output(f"{self.get_prompt()}{step.text}\n")
+            try:
+                self.run_planned(step)
+            except Exception as e:
+                self.print_error(f"[Ошибка в скрипте] {str(e)}\n")
+        if self.interrupted:
+            self.print_output("^C\nВыполнение скрипта прервано\n")
+        self.sink.flush()
+
+    def run_planned(self, step: PlannedCommand):
+        if step.pipe or step.redirect:
+            self.run_pipeline([(step.name, step.args)] + list(step.pipe), step.redirect)
+            return
+        entry = COMMANDS.get(step.name)
+        if entry is None:
+            self.print_error(f"Команда '{step.name}' не найдена\n")
+            return
+        entry.handler(self, list(step.args))
 
-        self.input_entry.delete(0, tk.END)
+    def run_lines(self, lines):
+        # Построчное выполнение скрипта или потока stdin
+        for line in lines:
+            if not self.running:
+                break
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            self.print_output(f"{self.get_prompt()}{line}\n")
+            try:
+                self.execute_command_from_script(line)
+            except Exception as e:
+                self.print_error(f"[Ошибка в скрипте] {str(e)}\n")
+        self.sink.flush()
 
-        return "break"
+    def execute_command_from_script(self, command: str):
+        stages, redirect = self.parse_pipeline(command)
+        if not stages:
+            return
+        if len(stages) > 1 or redirect:
+            self.run_pipeline(stages, redirect)
+            return
+        cmd, args = stages[0]
+        entry = COMMANDS.get(cmd)
+        if entry is None:
+            self.print_error(f"Команда '{cmd}' не найдена\n")
+            return
+        entry.handler(self, args)
+
+    def run_pipeline(self, stages, redirect=None):
+        # Стадии связаны генераторами: куски текста идут от команды к команде
+        # по мере чтения, промежуточный вывод целиком не накапливается
+        entries = []
+        for name, args in stages:
+            entry = COMMANDS.get(name)
+            if entry is None:
+                self.print_error(f"Команда '{name}' не найдена\n")
+                return
+            entries.append((entry, list(args)))
+        chunks = None
+        for entry, args in entries:
+            chunks = self.command_stream(entry, args, chunks)
+        if redirect:
+            self.write_file(redirect[1], chunks, redirect[0] == ">>")
+        else:
+            self.write_stream(chunks)
+
+    def write_file(self, path: str, chunks, append: bool = False):
+        # Вывод в файл VFS (">" и ">>")
+        try:
+            self.vfs_write(self.resolve_path(path), (chunk.encode("utf-8") for chunk in chunks), append)
+        except ValueError as e:
+            self.print_error(f"Ошибка: {str(e)}\n")
+
+    def vfs_write(self, abs_path: str, chunks, append: bool = False):
+        # Запись кусков байт в файл по абсолютному пути; общая для команд и
+        # повтора журнала. Несуществующий файл создаётся, куски дописываются
+        # в bytearray узла по мере поступления.
+        node = self.writable_node(abs_path)
+        if node is None:
+            dir_path, name = split_path(abs_path)
+            parent = self.vfs_index.lookup(dir_path)
+            if not parent or not parent.is_dir:
+                raise ValueError(f"директория '{dir_path}' не найдена")
+            parent = self.writable_node(dir_path)
+            name = sys.intern(name)
+            node = VfsNode(name, NODE_FILE | NODE_RAW | self.epoch << NODE_EPOCH_SHIFT,
+                           content=bytearray())
+            parent.get_children()[name] = node
+            self.name_index.invalidate(parent)
+            self.vfs_index.add(abs_path, node)
+        elif not node.is_file:
+            raise ValueError(f"'{abs_path}' является директорией")
+        buffer = node.open_write(append)
+        start = len(buffer)
+        self.content_cache.invalidate(node)
+        try:
+            for chunk in chunks:
+                buffer += chunk
+        finally:
+            # Команда могла прочитать и закэшировать этот же файл
+            self.content_cache.invalidate(node)
+            # Операция для журнала собирается только при открытом журнале:
+            # без него кодировать записанные данные незачем
+            if self.journal is not None:
+                with memoryview(buffer) as view:
+                    data = base64.b64encode(view[start:]).decode("ascii")
+                self.record_change({"op": "write", "path": abs_path, "append": append, "data": data})
+
+    def command_stream(self, entry: Command, args: List[str], stdin):
+        if entry.stream is not None:
+            return entry.stream(self, args, stdin)
+        return self.captured_output(entry, args)
+
+    def captured_output(self, entry: Command, args: List[str]):
+        # Команда без stream печатает через print_output; её вывод
+        # перехватывается и передаётся дальше одним куском, stdin не читается
+        sink, error_sink = self.sink, self.error_sink
+        buffer = BufferSink()
+        self.error_sink = error_sink or sink
+        self.sink = buffer
+        try:
+            entry.handler(self, args)
+        finally:
+            self.sink, self.error_sink = sink, error_sink
+        text = buffer.getvalue()
+        if text:
+            yield text
+
+    def cmd_exit(self, args: List[str]):
+        self.exit()
+
+    def cmd_help(self, args: List[str]):
+        self.print_output(commands_help())
 
     def cmd_ls(self, args: List[str]):
         target_path = self.current_dir if not args or args[0] in [".", "./"] else args[0]
         node = self.get_node_by_path(target_path)
-        if not node or node["type"] != "dir":
-            self.print_output(f"ls: путь '{target_path}' не найден\n")
+        if not node or not node.is_dir:
+            self.print_error(f"ls: путь '{target_path}' не найден\n")
             return
-        if not node["children"]:
+        if not node.get_children():
             self.print_output("(пусто)\n")
             return
-        items = "  ".join(node["children"].keys())
+        items = "  ".join(node.get_children().keys())
         self.print_output(f"{items}\n")
 
     def cmd_cd(self, args: List[str]):
@@ -244,227 +2308,943 @@ class TerminalEmulator:
         else:
             new_path = args[0]
 
-            # Обработка абсолютных путей
-            if new_path.startswith("/"):
-                abs_path = new_path
-            # Обработка пути ".." (на уровень выше)
-            elif new_path == "..":
-                if self.current_dir == "/":
-                    abs_path = "/"
-                else:
-                    parts = self.current_dir.rstrip("/").split("/")
-                    abs_path = "/" + "/".join(parts[:-1]) if len(parts) > 1 else "/"
-            else:
-                # Для всех относительных путей используем единую логику
-                current_parts = [p for p in self.current_dir.rstrip("/").split("/") if p]
-                new_parts = new_path.split("/")
-
-                for part in new_parts:
-                    if part == "..":
-                        if current_parts:
-                            current_parts.pop()
-                    elif part == "." or part == "":
-                        continue
-                    else:
-                        current_parts.append(part)
-
-                abs_path = "/" + "/".join(current_parts) if current_parts else "/"
-
-            # Нормализация
-            abs_path = abs_path.replace("//", "/")
-            if abs_path != "/" and abs_path.endswith("/"):
-                abs_path = abs_path[:-1]
-
-            node = self.get_node_by_path(abs_path)
-            if node and node["type"] == "dir":
+            # Абсолютные и относительные пути, "." и ".." разбирает resolve_path
+            abs_path = self.resolve_path(new_path)
+
+            node = self.vfs_index.lookup(abs_path)
+            if node and node.is_dir:
                 self.current_dir = abs_path
             else:
-                self.print_output(f"cd: путь '{new_path}' не найден\n")
+                self.print_error(f"cd: путь '{new_path}' не найден\n")
         self.update_prompt()
 
-    def auto_complete(self, event):
-        return "break"
-
-    def navigate_history_up(self, event):
-        if self.command_history and self.history_index > 0:
-            self.history_index -= 1
-            self.input_entry.delete(0, tk.END)
-            self.input_entry.insert(0, self.command_history[self.history_index])
-        return "break"
-
-    def navigate_history_down(self, event):
-        if self.command_history and self.history_index < len(self.command_history) - 1:
-            self.history_index += 1
-            self.input_entry.delete(0, tk.END)
-            self.input_entry.insert(0, self.command_history[self.history_index])
-        elif self.history_index == len(self.command_history) - 1:
-            self.history_index += 1
-            self.input_entry.delete(0, tk.END)
-        return "break"
-
-    def run_startup_script(self, script_path):
-        if not os.path.isfile(script_path):
-            self.print_output(f"Ошибка: стартовый скрипт '{script_path}' не найден\n")
+    def load_vfs(self, vfs_path):
+        if not os.path.isfile(vfs_path):
+            self.print_error(f"Ошибка: файл VFS '{vfs_path}' не найден\n")
+            self.set_vfs(empty_vfs())
             return
+        source = None
         try:
-            with open(script_path, 'r', encoding='utf-8') as f:
-                for line in f:
-                    line = line.strip()
-                    if not line or line.startswith('#'):
-                        continue
-                    self.print_output(f"{self.get_prompt()}{line}\n")
-                    try:
-                        self.execute_command_from_script(line)
-                    except Exception as e:
-                        self.print_output(f"[Ошибка в скрипте] {str(e)}\n")
+            if is_binary_image(vfs_path):
+                source = BinaryVfsSource(vfs_path)
+                root = source.parse()
+            elif self.lazy_vfs:
+                source = LazyJsonSource(vfs_path)
+                root = source.parse()
+            else:
+                with open(vfs_path, "r", encoding="utf-8") as f:
+                    root = json.load(f, object_hook=_vfs_object_hook)
+            if not isinstance(root, VfsNode) or not root.is_dir:
+                raise ValueError("корень VFS должен быть директорией")
+            self.set_vfs(root, source)
         except Exception as e:
-            self.print_output(f"Ошибка при чтении скрипта: {str(e)}\n")
+            if source:
+                source.close()
+            self.print_error(f"Ошибка при загрузке VFS: {str(e)}\n")
+            self.set_vfs(empty_vfs())
+            return
+        self.open_journal(vfs_path)
 
-    def execute_command_from_script(self, command: str):
-        cmd, args = self.parse_command(command)
-        if cmd == "exit":
-            self.root.quit()
-        elif cmd == "ls":
-            self.cmd_ls(args)
-        elif cmd == "cd":
-            self.cmd_cd(args)
-        elif cmd == "wc":
-            self.cmd_wc(args)
-        elif cmd == "uniq":
-            self.cmd_uniq(args)
-        elif cmd == "mv":
-            self.cmd_mv(args)
-        elif cmd:
-            self.print_output(f"Команда '{cmd}' не найдена\n")
+    def open_journal(self, vfs_path):
+        journal = VfsJournal(vfs_path, self.autosave)
+        try:
+            ops = journal.read()
+        except OSError as e:
+            self.print_error(f"Ошибка чтения журнала '{journal.path}': {str(e)}\n")
+            ops = []
+        if ops is None:
+            self.print_output(f"Журнал '{journal.path}' не соответствует образу VFS и не применён\n")
+            ops = []
+        # Повтор операций до подключения журнала, чтобы они не записались снова
+        for number, op in enumerate(ops, 1):
+            try:
+                self.apply_change(op)
+            except (ValueError, KeyError, TypeError) as e:
+                self.print_error(f"Ошибка в журнале '{journal.path}', запись {number}: {str(e)}\n")
+                journal.full = True
+                break
+        self.journal = journal
+
+    def apply_change(self, op: dict):
+        if op["op"] == "mv":
+            self.vfs_move(op["from"], op["to"])
+        elif op["op"] == "write":
+            self.vfs_write(op["path"], (base64.b64decode(op["data"]),), op["append"])
+        else:
+            raise ValueError(f"неизвестная операция '{op['op']}'")
 
-    def load_vfs(self, vfs_path):
-        if not os.path.isfile(vfs_path):
-            self.print_output(f"Ошибка: файл VFS '{vfs_path}' не найден\n")
-            self.vfs = {"type": "dir", "name": "/", "children": {}}
+    def record_change(self, op: dict):
+        if self.journal is None:
             return
-        try:
-            with open(vfs_path, "r", encoding="utf-8") as f:
-                self.vfs = json.load(f)
-        except Exception as e:
-            self.print_output(f"Ошибка при загрузке VFS: {str(e)}\n")
-            self.vfs = {"type": "dir", "name": "/", "children": {}}
+        self.journal.record(op)
+        if self.autosave:
+            self.sync_vfs()
+
+    def sync_vfs(self, compact: bool = False) -> bool:
+        # Дописывает журнал; образ пересобирается по запросу или когда журнал
+        # разросся. Возвращает True, если образ был пересобран.
+        journal = self.journal
+        if not (compact or journal.full):
+            journal.flush()
+            if not journal.needs_compaction():
+                return False
+        journal.compact(self.vfs)
+        return True
+
+    def set_vfs(self, root, source=None):
+        # source — открытый источник ленивого содержимого, живёт вместе с
+        # деревом и снимками, которые на него ссылаются
+        if (self.vfs_source is not None and self.vfs_source is not source
+                and all(snapshot.source is not self.vfs_source for snapshot in self.snapshots.values())):
+            self.vfs_source.close()
+        self.vfs = root
+        self.vfs_source = source
+        self.vfs_index = VfsIndex(root)
+        self.name_index.clear()
+        self.content_cache.clear()
+        self.journal = None
+
+    def snapshot(self, name=None) -> VfsSnapshot:
+        # Снимок за O(1): дерево не копируется, только начинается новая
+        # эпоха. Именованный снимок доступен командам restore и snapshot.
+        snapshot = VfsSnapshot(self.vfs, self.vfs_source, self.current_dir)
+        self.epoch += 1
+        if name is not None:
+            self.snapshots[name] = snapshot
+        return snapshot
+
+    def restore(self, snapshot):
+        if not isinstance(snapshot, VfsSnapshot):
+            snapshot = self.snapshots[snapshot]
+        # Дерево снимка остаётся неизменным: новая эпоха заставит копировать
+        # его узлы при записи. Кэш содержимого по узлам остаётся верным.
+        self.epoch += 1
+        self.vfs = snapshot.root
+        self.vfs_source = snapshot.source
+        self.vfs_index = VfsIndex(snapshot.root)
+        self.name_index.clear()
+        self.current_dir = snapshot.current_dir
+        self.update_prompt()
+        if self.journal is not None:
+            # Откат не выражается операциями журнала: образ пересобирается
+            self.journal.pending = []
+            self.journal.full = True
+            if self.autosave:
+                self.sync_vfs()
+
+    def writable_node(self, path: str):
+        # Узел по абсолютному пути, который можно менять. Узел из снимка
+        # копируется, копия подставляется в родителя (тоже при необходимости
+        # скопированного) и в индекс; поддеревья вне пути остаются общими.
+        node = self.vfs_index.lookup(path)
+        if node is None or node.epoch == self.epoch:
+            return node
+        copy = node.copy(self.epoch)
+        if path == "/":
+            self.vfs = copy
+        else:
+            dir_path, name = split_path(path)
+            self.writable_node(dir_path).get_children()[name] = copy
+        self.vfs_index.add(path, copy)
+        return copy
+
+    def complete(self, line: str) -> Tuple[str, List[str]]:
+        # Дополнение последнего слова строки: имя команды в начале строки или
+        # после "|", иначе путь VFS относительно текущей директории.
+        # Возвращает строку, продлённую до общего префикса кандидатов
+        # (с " " или "/" в конце, если кандидат один), и список кандидатов.
+        start = len(line)
+        while start > 0 and not (line[start - 1] in " \t|" and line[start - 2:start - 1] != "\\"):
+            start -= 1
+        word = line[start:].replace("\\ ", " ")
+        if not line[:start].strip() or line[:start].rstrip().endswith("|"):
+            names = sorted(COMMANDS)
+            position = bisect.bisect_left(names, word)
+            candidates = []
+            while position < len(names) and names[position].startswith(word):
+                candidates.append(names[position])
+                position += 1
+            head, prefix, suffix = "", word, " "
+        else:
+            head, _, prefix = word.rpartition("/")
+            if word.startswith("/") and not head:
+                head = "/"
+            node = self.get_node_by_path(head or ".")
+            if node is None or not node.is_dir:
+                return line, []
+            candidates = self.name_index.matches(node, prefix)
+            if head and not head.endswith("/"):
+                head += "/"
+            suffix = " "
+            if len(candidates) == 1 and node.get_children()[candidates[0]].is_dir:
+                suffix = "/"
+        if not candidates:
+            return line, []
+        if len(candidates) == 1:
+            completion = candidates[0]
+        else:
+            completion, suffix = os.path.commonprefix(candidates), ""
+            if len(completion) <= len(prefix):
+                return line, candidates
+        return line[:start] + (head + completion).replace(" ", "\\ ") + suffix, candidates
+
+    def resolve_path(self, path: str) -> str:
+        return normalize_path(path, self.current_dir)
 
     def get_node_by_path(self, path: str):
-        path = path.replace("\\", "/")
+        return self.vfs_index.lookup(self.resolve_path(path))
 
-        if not path.startswith("/"):
-            if self.current_dir == "/":
-                path = "/" + path
+    def open_text(self, path: str):
+        # Текст файла кусками. Файл из кэша отдаётся кусками готовой строки;
+        # файл, который помещается в долю бюджета кэша, декодируется потоком
+        # и после полного прочтения попадает в кэш, а больший файл
+        # декодируется потоком с постоянной памятью.
+        node = self.get_node_by_path(path)
+        if not node or not node.is_file:
+            self.print_error(f"Ошибка: файл '{path}' не найден\n")
+            return None
+        text = self.content_cache.get(node)
+        if text is not None:
+            return self.interruptible(text[start:start + TEXT_CHUNK_SIZE]
+                                      for start in range(0, len(text), TEXT_CHUNK_SIZE))
+        content, raw = node.peek_content()
+        size = len(content) if raw else len(content) // 4 * 3
+        if size <= self.content_cache.max_bytes // CONTENT_CACHE_FILE_SHARE:
+            return self.interruptible(self.caching_text(node))
+        return self.interruptible(iter_node_text(node))
+
+    def caching_text(self, node: VfsNode):
+        # Куски текста по мере декодирования; прочитанный до конца файл
+        # кладётся в кэш одной строкой
+        chunks = []
+        for chunk in iter_node_text(node):
+            chunks.append(chunk)
+            yield chunk
+        self.content_cache.put(node, "".join(chunks))
+
+    def interruptible(self, chunks):
+        for chunk in chunks:
+            if self.interrupted:
+                raise CommandInterrupted("прервано")
+            yield chunk
+
+    def split_options(self, name: str, args: List[str], allowed: str):
+        # Ключи вида "-lw" и позиционные аргументы; None при неизвестном ключе
+        options = set()
+        paths = []
+        for arg in args:
+            if arg.startswith("-") and len(arg) > 1:
+                for option in arg[1:]:
+                    if option not in allowed:
+                        self.print_error(f"{name}: неизвестный ключ '-{option}'\n")
+                        return None, None
+                    options.add(option)
             else:
-                path = self.current_dir.rstrip("/") + "/" + path
+                paths.append(arg)
+        return options, paths
 
-        parts = path.strip("/").split("/")
-        node = self.vfs
-        for part in parts:
-            if part == "":
-                continue
-            if node["type"] != "dir" or part not in node["children"]:
-                return None
-            node = node["children"][part]
-        return node
+    def cmd_cat(self, args: List[str]):
+        self.write_stream(self.stream_cat(args, None))
 
-    def read_file_content(self, path: str) -> str:
-        node = self.get_node_by_path(path)
-        if not node or node["type"] != "file":
-            self.print_output(f"Ошибка: файл '{path}' не найден\n")
-            return ""
-        try:
-            content_bytes = base64.b64decode(node["content"])
-            return content_bytes.decode("utf-8")
-        except Exception as e:
-            self.print_output(f"Ошибка чтения файла '{path}': {str(e)}\n")
-            return ""
+    def stream_cat(self, args: List[str], stdin):
+        if not args:
+            if stdin is None:
+                self.print_error("cat: укажите путь к файлу\n")
+                return
+            yield from stdin
+            return
+        for path in args:
+            try:
+                chunks = self.open_text(path)
+                if chunks is not None:
+                    yield from chunks
+            except ValueError as e:
+                self.print_error(f"Ошибка чтения файла '{path}': {str(e)}\n")
 
     def cmd_wc(self, args: List[str]):
-        if not args:
-            self.print_output("wc: укажите путь к файлу\n")
+        self.write_stream(self.stream_wc(args, None))
+
+    def stream_wc(self, args: List[str], stdin):
+        options, paths = self.split_options("wc", args, "lwmc")
+        if options is None:
             return
-        path = args[0]
-        content = self.read_file_content(path)
-        if not content:
+        if not paths and stdin is None:
+            self.print_error("wc: укажите путь к файлу\n")
             return
-        lines = content.splitlines()
-        words = content.split()
-        chars = len(content)
-        self.print_output(f"{len(lines)} {len(words)} {chars} {path}\n")
+        # Как в GNU wc: -c — байты (UTF-8), -m — символы; без ключей
+        # выводятся строки, слова и байты
+        columns = [option for option in "lwmc" if option in options] or ["l", "w", "c"]
+        flags = ("l" in columns, "w" in columns, "c" in columns)
+        if not paths:
+            counts = dict(zip("lwmc", count_text(stdin, *flags)))
+            yield " ".join(str(counts[column]) for column in columns) + "\n"
+            return
+        totals = {"l": 0, "w": 0, "m": 0, "c": 0}
+        for path in paths:
+            try:
+                chunks = self.open_text(path)
+                if chunks is None:
+                    continue
+                counts = dict(zip("lwmc", count_text(chunks, *flags)))
+            except ValueError as e:
+                self.print_error(f"Ошибка чтения файла '{path}': {str(e)}\n")
+                continue
+            for column in columns:
+                totals[column] += counts[column]
+            yield " ".join(str(counts[column]) for column in columns) + f" {path}\n"
+        if len(paths) > 1:
+            yield " ".join(str(totals[column]) for column in columns) + " итого\n"
 
     def cmd_uniq(self, args: List[str]):
-        if not args:
-            self.print_output("uniq: укажите путь к файлу\n")
+        self.write_stream(self.stream_uniq(args, None))
+
+    def stream_uniq(self, args: List[str], stdin):
+        options, paths = self.split_options("uniq", args, "cdui")
+        if options is None:
             return
-        path = args[0]
-        content = self.read_file_content(path)
-        if not content:
+        if not paths and stdin is None:
+            self.print_error("uniq: укажите путь к файлу\n")
             return
-        lines = content.splitlines()
-        unique_lines = []
-        for line in lines:
-            if not unique_lines or unique_lines[-1] != line:
-                unique_lines.append(line)
-        for line in unique_lines:
-            self.print_output(line + "\n")
+        path = paths[0] if paths else None
+        try:
+            chunks = self.open_text(path) if path else stdin
+            if chunks is None:
+                return
+            # Вывод пачками по OUTPUT_BATCH_LINES строк
+            batch = []
+            for count, line in iter_uniq_groups(iter_text_lines(chunks), "i" in options):
+                if "d" in options and count < 2 or "u" in options and count > 1:
+                    continue
+                batch.append(f"{count:7d} {line}\n" if "c" in options else line + "\n")
+                if len(batch) >= OUTPUT_BATCH_LINES:
+                    yield "".join(batch)
+                    batch = []
+            if batch:
+                yield "".join(batch)
+        except ValueError as e:
+            self.print_error(f"Ошибка чтения файла '{path}': {str(e)}\n")
 
     def cmd_mv(self, args: List[str]):
         if len(args) < 2:
-            self.print_output("mv: укажите исходный и целевой пути\n")
+            self.print_error("mv: укажите исходный и целевой пути\n")
             return
 
         source_path = args[0]
         target_path = args[1]
 
         # Получаем исходный узел
-        source_node = self.get_node_by_path(source_path)
-        if not source_node:
-            self.print_output(f"mv: исходный путь '{source_path}' не найден\n")
+        source_abs = self.resolve_path(source_path)
+        source_node = self.vfs_index.lookup(source_abs)
+        if not source_node or source_abs == "/":
+            self.print_error(f"mv: исходный путь '{source_path}' не найден\n")
             return
 
         # Получаем родительскую директорию исходного узла
-        source_dir_path = "/".join(source_path.rstrip("/").split("/")[:-1]) or "/"
-        source_dir = self.get_node_by_path(source_dir_path)
-        source_name = source_path.rstrip("/").split("/")[-1]
+        source_dir = self.vfs_index.parent(source_abs)
+        source_name = split_path(source_abs)[1]
 
         # Получаем целевую директорию
-        target_node = self.get_node_by_path(target_path)
+        target_abs = self.resolve_path(target_path)
+        target_node = self.vfs_index.lookup(target_abs)
 
         # Если целевой путь существует и это директория, перемещаем в неё
-        if target_node and target_node["type"] == "dir":
+        if target_node and target_node.is_dir:
             target_dir = target_node
             new_name = source_name
+            new_abs = target_abs.rstrip("/") + "/" + new_name
         else:
             # Иначе считаем target_path полным путем к новому файлу/директории
-            target_dir_path = "/".join(target_path.rstrip("/").split("/")[:-1]) or "/"
-            target_dir = self.get_node_by_path(target_dir_path)
-            new_name = target_path.rstrip("/").split("/")[-1]
+            target_dir_path, new_name = split_path(target_abs)
+            target_dir = self.vfs_index.lookup(target_dir_path)
+            new_abs = target_abs
 
-            if not target_dir or target_dir["type"] != "dir":
-                self.print_output(f"mv: целевая директория '{target_dir_path}' не найдена\n")
+            if not target_dir or not target_dir.is_dir:
+                self.print_error(f"mv: целевая директория '{target_dir_path}' не найдена\n")
                 return
 
+        # Директорию нельзя переместить внутрь неё самой
+        if new_abs.startswith(source_abs + "/"):
+            self.print_error(f"mv: нельзя переместить '{source_path}' внутрь самого себя\n")
+            return
+
         # Проверяем, не существует ли уже элемент с таким именем в целевой директории
-        if new_name in target_dir["children"]:
-            self.print_output(f"mv: '{new_name}' уже существует в целевой директории\n")
+        if new_name in target_dir.get_children():
+            self.print_error(f"mv: '{new_name}' уже существует в целевой директории\n")
             return
 
+        self.vfs_move(source_abs, new_abs)
+
+        self.print_output(f"Перемещено '{source_path}' -> '{target_path}'\n")
+
+    def vfs_move(self, source_abs: str, new_abs: str):
+        # Перемещение по абсолютным путям; общее для mv и повтора журнала
+        source_node = self.vfs_index.lookup(source_abs)
+        source_dir = self.vfs_index.parent(source_abs)
+        target_dir = self.vfs_index.parent(new_abs)
+        source_name = split_path(source_abs)[1]
+        new_name = sys.intern(split_path(new_abs)[1])
+        if (source_node is None or source_dir is None or source_abs == "/" or target_dir is None
+                or not target_dir.is_dir or new_name in target_dir.get_children()):
+            raise ValueError(f"нельзя переместить '{source_abs}' -> '{new_abs}'")
+
+        # Директории, которые меняются, и переименованный узел не должны
+        # принадлежать снимку
+        source_dir = self.writable_node(split_path(source_abs)[0])
+        target_dir = self.writable_node(split_path(new_abs)[0])
+        if source_node.name != new_name and source_node.epoch != self.epoch:
+            source_node = source_node.copy(self.epoch)
+
         # Перемещаем узел
-        target_dir["children"][new_name] = source_node
-        del source_dir["children"][source_name]
+        target_dir.get_children()[new_name] = source_node
+        del source_dir.get_children()[source_name]
+        self.name_index.invalidate(source_dir)
+        self.name_index.invalidate(target_dir)
+        self.vfs_index.discard(source_abs)
+        self.vfs_index.add(new_abs, source_node)
 
         # Обновляем имя узла если оно изменилось
-        if source_node["name"] != new_name:
-            source_node["name"] = new_name
+        if source_node.name != new_name:
+            source_node.name = new_name
 
-        self.print_output(f"Перемещено '{source_path}' -> '{target_path}'\n")
+        self.record_change({"op": "mv", "from": source_abs, "to": new_abs})
+
+    def cmd_snapshot(self, args: List[str]):
+        if not args:
+            names = "  ".join(self.snapshots)
+            self.print_output(f"{names or '(нет снимков)'}\n")
+            return
+        self.snapshot(args[0])
+        self.print_output(f"Снимок '{args[0]}' создан\n")
+
+    def cmd_restore(self, args: List[str]):
+        if not args:
+            self.print_error("restore: укажите имя снимка\n")
+            return
+        if args[0] not in self.snapshots:
+            self.print_error(f"restore: снимок '{args[0]}' не найден\n")
+            return
+        self.restore(args[0])
+        self.print_output(f"VFS восстановлена из снимка '{args[0]}'\n")
+
+    def cmd_save(self, args: List[str]):
+        options, paths = self.split_options("save", args, "c")
+        if options is None:
+            return
+        try:
+            if paths:
+                # Полный образ в новый файл; дальше журнал ведётся для него
+                save_image(self.vfs, paths[0])
+                self.journal = VfsJournal(paths[0], self.autosave)
+                self.journal.reset()
+                self.vfs_path = paths[0]
+                self.print_output(f"VFS сохранена в '{paths[0]}'\n")
+            elif self.journal is None:
+                self.print_error("save: VFS не загружена из файла, укажите путь\n")
+            elif self.sync_vfs("c" in options):
+                self.print_output(f"Образ VFS '{self.journal.image_path}' пересобран\n")
+            else:
+                self.print_output(f"Изменения записаны в журнал '{self.journal.path}'\n")
+        except OSError as e:
+            self.print_error(f"save: {str(e)}\n")
+
+
+register_command("ls", ShellCore.cmd_ls, "[путь]", "список файлов")
+register_command("cd", ShellCore.cmd_cd, "[директория]", "сменить директорию")
+register_command("cat", ShellCore.cmd_cat, "[файлы]", "вывести содержимое файлов",
+                 stream=ShellCore.stream_cat)
+register_command("wc", ShellCore.cmd_wc, "[-lwmc] [файлы]",
+                 "подсчитать строки, слова, символы (-m) и байты (-c) в файлах",
+                 stream=ShellCore.stream_wc)
+register_command("uniq", ShellCore.cmd_uniq, "[-cdui] [файл]", "вывести уникальные строки файла",
+                 stream=ShellCore.stream_uniq)
+register_command("mv", ShellCore.cmd_mv, "[источник] [цель]",
+                 "переместить или переименовать файл/директорию", mutates=True)
+register_command("snapshot", ShellCore.cmd_snapshot, "[имя]",
+                 "сделать снимок VFS (без имени — список снимков)")
+register_command("restore", ShellCore.cmd_restore, "[имя]", "вернуть VFS к снимку", mutates=True)
+register_command("save", ShellCore.cmd_save, "[-c] [путь]",
+                 "сохранить изменения VFS (-c — пересобрать образ)")
+register_command("help", ShellCore.cmd_help, "", "список команд")
+register_command("exit", ShellCore.cmd_exit, "", "выход из эмулятора")
+
+
+class TerminalEmulator(ShellCore):
+    # Графическая оболочка над ShellCore: вывод идёт в виртуализированную
+    # панель OutputView
+    def __init__(self, root, vfs_path=None, startup_script=None,
+                 scrollback=DEFAULT_SCROLLBACK, scrollback_file=None, lazy_vfs=False,
+                 cache_bytes=DEFAULT_CONTENT_CACHE_BYTES, plan_cache_dir=DEFAULT_PLAN_CACHE_DIR,
+                 autosave=False, ps1=None, history_path=DEFAULT_HISTORY_PATH):
+        self.root = root
+
+        self.init_prompt(ps1)
+
+        self.root.title(self.get_window_title())
+
+        self.terminal_font = font.Font(family="Courier New", size=10)
+
+        self.scrollback = Scrollback(scrollback, scrollback_file)
+
+        self.create_widgets()
 
+        self.widget_sink = TextWidgetSink(self.output_view)
+
+        self.sink = self.widget_sink
+
+        self.script_thread = None
+
+        self.script_queue = queue.Queue()
+
+        self.welcome_message()
+
+        super().__init__(vfs_path=vfs_path, startup_script=startup_script, sink=self.sink,
+                         lazy_vfs=lazy_vfs, cache_bytes=cache_bytes,
+                         plan_cache_dir=plan_cache_dir, autosave=autosave, ps1=ps1)
+
+        self.input_entry.focus_set()
+
+        self.input_entry.bind('<Return>', self.execute_command)
+
+        self.input_entry.bind('<Tab>', self.auto_complete)
+
+        # История читается из файла при первом обращении; history_index —
+        # позиция при листании, None — после последней команды
+        self.command_history = CommandHistory(history_path)
+        self.history_index = None
+
+        # Состояние Ctrl+R: исходный текст строки, запрос и найденная команда
+        self.search_saved = None
+        self.search_match = None
+
+        self.input_entry.bind('<Up>', self.navigate_history_up)
+        self.input_entry.bind('<Down>', self.navigate_history_down)
+
+        self.input_entry.bind('<Control-r>', self.reverse_search)
+        self.input_entry.bind('<KeyRelease>', self.update_search)
+        self.input_entry.bind('<Escape>', self.cancel_search)
+
+        self.root.bind('<Control-c>', self.interrupt_script)
+
+        # Переход к строке и панель поиска по выводу
+        self.root.bind('<Control-g>', self.ask_goto_line)
+        self.root.bind('<Control-f>', self.find_bar.open)
+        self.root.bind('<F3>', lambda event: self.find_bar.find_next(False))
+        self.root.bind('<Shift-F3>', lambda event: self.find_bar.find_next(True))
+
+        self.print_output(f"[DEBUG] VFS Path: {self.vfs_path}\n")
+        self.print_output(f"[DEBUG] Startup Script: {self.startup_script}\n")
+
+        if self.startup_script:
+            self.start_script(self.startup_script)
+
+    def get_window_title(self) -> str:
+        return f"Эмулятор - [{user_name()}@{host_name()}]"
+
+    def create_widgets(self):
+        main_frame = tk.Frame(self.root)
+        main_frame.pack(fill=tk.BOTH, expand=True, padx=2, pady=2)
+
+        self.output_view = OutputView(main_frame, self.scrollback, self.terminal_font)
+        self.find_bar = FindBar(self.output_view, self.terminal_font)
+
+        input_frame = tk.Frame(main_frame, bg='black')
+        input_frame.pack(fill=tk.X, pady=(2, 0))
+
+        self.prompt_label = tk.Label(
+            input_frame,
+            text=self.get_prompt(),
+            font=self.terminal_font,
+            bg='black',
+            fg='green',
+            anchor='w'
+        )
+        self.prompt_label.pack(side=tk.LEFT)
+
+        self.input_entry = tk.Entry(
+            input_frame,
+            font=self.terminal_font,
+            bg='black',
+            fg='white',
+            insertbackground='white',
+            relief=tk.FLAT
+        )
+        self.input_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(2, 0))
+
+    def welcome_message(self):
+        welcome_text = f"""Добро пожаловать в эмулятор терминала!
+Доступные команды:
+{commands_help()}
+Попробуйте ввести команды с аргументами в кавычках!
+"""
+        self.print_output(welcome_text)
+
+    def update_prompt(self):
+        # Пока работает скрипт, в строке приглашения показывается прогресс;
+        # приглашение обновится по завершении
+        if self.script_thread is None:
+            self.prompt_label.config(text=self.get_prompt())
+
+    def exit(self):
+        super().exit()
+        if self.script_thread is None:
+            self.root.quit()
+
+    def start_script(self, script_path):
+        # Скрипт выполняется в рабочем потоке, вывод и прогресс приходят через
+        # script_queue и разбираются в главном потоке по таймеру
+        self.interrupted = False
+        self.sink = QueueSink(self.script_queue)
+        self.script_thread = threading.Thread(target=self.script_worker, args=(script_path,),
+                                              daemon=True)
+        self.script_thread.start()
+        self.root.after(SCRIPT_POLL_MS, self.poll_script)
+
+    def script_worker(self, script_path):
+        try:
+            self.run_startup_script(script_path)
+        finally:
+            self.script_queue.put(("done", None))
+
+    def on_script_progress(self, done: int, total: int):
+        self.script_queue.put(("progress", (done, total)))
+
+    def poll_script(self):
+        finished = False
+        while True:
+            try:
+                kind, payload = self.script_queue.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "out":
+                self.widget_sink.write(payload)
+            elif kind == "progress":
+                self.prompt_label.config(text=f"[скрипт {payload[0] + 1}/{payload[1]}, Ctrl+C - прервать] ")
+            elif kind == "done":
+                finished = True
+        if not finished:
+            self.root.after(SCRIPT_POLL_MS, self.poll_script)
+            return
+        # Ctrl+C прерывает только скрипт: дальше команды из строки ввода
+        # выполняются без флага
+        self.script_thread = None
+        self.interrupted = False
+        self.sink = self.widget_sink
+        self.update_prompt()
+        if not self.running:
+            self.root.quit()
+
+    def interrupt_script(self, event=None):
+        if self.script_thread is None:
+            return None
+        self.interrupted = True
+        return "break"
+
+    def execute_command(self, event=None):
+        # Enter в режиме поиска выполняет найденную команду
+        self.finish_search()
+
+        command = self.input_entry.get().strip()
+
+        if not command:
+            self.input_entry.delete(0, tk.END)
+            return
+
+        if self.script_thread is not None:
+            # self.sink принадлежит рабочему потоку и может быть подменён
+            # буфером конвейера, поэтому сообщение пишется прямо в окно
+            self.widget_sink.write("Выполняется стартовый скрипт, дождитесь окончания или нажмите Ctrl+C\n")
+            return "break"
+
+        self.command_history.add(command)
+        self.history_index = None
+
+        self.print_output(f"{self.get_prompt()}{command}\n")
+
+        try:
+            self.execute_command_from_script(command)
+        except Exception as e:
+            self.print_error(f"Ошибка: {str(e)}\n")
+
+        self.input_entry.delete(0, tk.END)
+
+        return "break"
+
+    def auto_complete(self, event):
+        # Дополняется текст до курсора; если продлить нечего, а кандидатов
+        # несколько, они выводятся списком. Пока рабочий поток скрипта меняет
+        # VFS, обходить её из главного потока нельзя
+        if self.script_thread is not None:
+            return "break"
+        cursor = self.input_entry.index(tk.INSERT)
+        line = self.input_entry.get()
+        head, candidates = self.complete(line[:cursor])
+        if head != line[:cursor]:
+            self.input_entry.delete(0, tk.END)
+            self.input_entry.insert(0, head + line[cursor:])
+            self.input_entry.icursor(len(head))
+        elif len(candidates) > 1:
+            shown = "  ".join(candidates[:COMPLETION_LIST_LIMIT])
+            if len(candidates) > COMPLETION_LIST_LIMIT:
+                shown += f"  ... и ещё {len(candidates) - COMPLETION_LIST_LIMIT}"
+            self.print_output(f"{self.get_prompt()}{line}\n{shown}\n")
+        return "break"
+
+    def navigate_history_up(self, event):
+        if self.leave_search():
+            return "break"
+        items = self.command_history.items()
+        if self.history_index is None:
+            self.history_index = len(items)
+        if self.history_index > 0:
+            self.history_index -= 1
+            self.input_entry.delete(0, tk.END)
+            self.input_entry.insert(0, items[self.history_index])
+        return "break"
+
+    def navigate_history_down(self, event):
+        if self.leave_search():
+            return "break"
+        items = self.command_history.items()
+        if self.history_index is None:
+            return "break"
+        if self.history_index < len(items) - 1:
+            self.history_index += 1
+            self.input_entry.delete(0, tk.END)
+            self.input_entry.insert(0, items[self.history_index])
+        else:
+            self.history_index = None
+            self.input_entry.delete(0, tk.END)
+        return "break"
+
+    def ask_goto_line(self, event=None):
+        number = simpledialog.askinteger("Переход", "Номер строки вывода:", parent=self.root,
+                                         minvalue=1)
+        if number is not None:
+            self.output_view.show_line(number - 1)
+        self.input_entry.focus_set()
+        return "break"
+
+    def reverse_search(self, event=None):
+        # Ctrl+R: строка ввода становится запросом, найденная команда
+        # показывается в приглашении; повторный Ctrl+R ищет более старую
+        if self.search_saved is None:
+            self.search_saved = self.input_entry.get()
+            self.search_match = None
+            self.input_entry.delete(0, tk.END)
+        elif self.search_match is not None:
+            older = self.command_history.search(self.input_entry.get(), self.search_match)
+            if older is not None:
+                self.search_match = older
+        self.show_search()
+        return "break"
+
+    def update_search(self, event):
+        # Ctrl+R, Enter, Escape и стрелки обрабатываются своими привязками
+        if (self.search_saved is None or event.state & 0x4
+                or event.keysym in ("Control_L", "Control_R", "Return", "Escape", "Up", "Down", "Tab")):
+            return None
+        query = self.input_entry.get()
+        self.search_match = self.command_history.search(query) if query else None
+        self.show_search()
+        return None
+
+    def show_search(self):
+        query = self.input_entry.get()
+        state = "" if self.search_match is not None or not query else "неудачный "
+        self.prompt_label.config(text=f"({state}reverse-i-search)`{query}': {self.search_match or ''}  ")
+
+    def finish_search(self):
+        # Выход из поиска с найденной командой в строке ввода
+        if self.search_saved is None:
+            return None
+        match = self.search_match
+        self.input_entry.delete(0, tk.END)
+        self.input_entry.insert(0, match if match is not None else self.search_saved)
+        self.search_saved = None
+        self.search_match = None
+        self.update_prompt()
+        return match
+
+    def leave_search(self) -> bool:
+        # Стрелка в режиме поиска только выходит из него с найденной командой;
+        # дальше история листается от её позиции
+        if self.search_saved is None:
+            return False
+        match = self.finish_search()
+        self.history_index = None if match is None else self.command_history.items().index(match)
+        return True
+
+    def cancel_search(self, event=None):
+        if self.search_saved is not None:
+            self.search_match = None
+            self.finish_search()
+        return "break"
+
+
+def run_headless(vfs_path=None, startup_script=None, output_path=None, lazy_vfs=False,
+                 cache_bytes=DEFAULT_CONTENT_CACHE_BYTES, plan_cache_dir=DEFAULT_PLAN_CACHE_DIR,
+                 autosave=False, ps1=None) -> int:
+    # Пакетный режим без Tk: скрипт из --script= (или stdin) выполняется
+    # над VFS, вывод идёт в stdout или в файл --output=
+    out = open(output_path, "w", encoding="utf-8") if output_path else sys.stdout
+    try:
+        shell = ShellCore(vfs_path=vfs_path, startup_script=startup_script,
+                          sink=StreamSink(out), lazy_vfs=lazy_vfs, cache_bytes=cache_bytes,
+                          plan_cache_dir=plan_cache_dir, autosave=autosave, ps1=ps1)
+        if startup_script and startup_script != "-":
+            shell.run_startup_script(startup_script)
+        else:
+            shell.run_lines(sys.stdin)
+    finally:
+        if output_path:
+            out.close()
+    return 0
+
+
+# Состояние пакетного режима в процессе: задания, параметры ядра и
+# загруженные VFS ("путь -> (ядро, снимок исходного состояния, число ошибок
+# загрузки)")
+_BATCH_ENTRIES = []
+_BATCH_OPTIONS = {}
+_BATCH_SHELLS = {}
+
+
+def load_batch_manifest(manifest_path: str) -> List[dict]:
+    # Манифест — JSON-список заданий {"vfs": ..., "script": ..., "output": ...}
+    # или пар [vfs, script]. Относительные пути — от каталога манифеста.
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if not isinstance(data, list):
+        raise ValueError("манифест должен быть списком заданий")
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    entries = []
+    for item in data:
+        if isinstance(item, list) and len(item) == 2:
+            item = {"vfs": item[0], "script": item[1]}
+        if not isinstance(item, dict) or not item.get("script"):
+            raise ValueError(f"неверное задание в манифесте: {item!r}")
+        entry = {}
+        for key in ("vfs", "script", "output"):
+            if item.get(key):
+                entry[key] = os.path.join(base_dir, item[key])
+        entries.append(entry)
+    return entries
+
+
+def _batch_init(entries, options):
+    global _BATCH_ENTRIES, _BATCH_OPTIONS
+    _BATCH_ENTRIES = entries
+    _BATCH_OPTIONS = options
+
+
+def _batch_shell(vfs_path):
+    # VFS загружается один раз на процесс; при fork воркеры получают уже
+    # загруженные в родителе деревья и делят их страницы с ним
+    loaded = _BATCH_SHELLS.get(vfs_path)
+    if loaded is None:
+        shell = ShellCore(vfs_path=vfs_path, sink=BufferSink(), **_BATCH_OPTIONS)
+        # Скрипты из разных процессов не должны писать в один образ
+        shell.journal = None
+        # Вывод и число ошибок загрузки VFS попадают в результат каждого
+        # скрипта над этим образом
+        loaded = _BATCH_SHELLS[vfs_path] = (shell, shell.snapshot(), shell.error_count,
+                                            shell.sink.getvalue())
+    return loaded
+
+
+def _batch_task(index: int) -> dict:
+    entry = _BATCH_ENTRIES[index]
+    result = {"index": index, "vfs": entry.get("vfs"), "script": entry["script"]}
+    started = time.perf_counter()
+    try:
+        shell, base, load_errors, load_output = _batch_shell(entry.get("vfs"))
+        # Каждый скрипт начинается с исходного состояния VFS
+        shell.restore(base)
+        shell.sink = BufferSink()
+        shell.running = True
+        shell.interrupted = False
+        shell.error_count = 0
+        shell.run_startup_script(entry["script"])
+        output = load_output + shell.sink.getvalue()
+        result["errors"] = shell.error_count + load_errors
+        result["exit_code"] = 1 if result["errors"] else 0
+    except Exception as e:
+        output = ""
+        result["errors"] = 1
+        result["exit_code"] = 2
+        result["exception"] = f"{type(e).__name__}: {str(e)}"
+    result["elapsed"] = round(time.perf_counter() - started, 6)
+    if entry.get("output"):
+        with open(entry["output"], "w", encoding="utf-8") as f:
+            f.write(output)
+        result["output_path"] = entry["output"]
+    else:
+        result["output"] = output
+    return result
+
+
+def run_batch(manifest_path, jobs=None, report_path=None, lazy_vfs=False,
+              cache_bytes=DEFAULT_CONTENT_CACHE_BYTES, plan_cache_dir=DEFAULT_PLAN_CACHE_DIR) -> int:
+    # Пакетный прогон заданий манифеста на пуле процессов. Отчёт — JSON со
+    # статусом, числом ошибок и выводом каждого скрипта; код возврата 0,
+    # только если все скрипты прошли без ошибок.
+    try:
+        entries = load_batch_manifest(manifest_path)
+    except (OSError, ValueError) as e:
+        print(f"Ошибка чтения манифеста: {str(e)}")
+        return 1
+    options = {"lazy_vfs": lazy_vfs, "cache_bytes": cache_bytes, "plan_cache_dir": plan_cache_dir}
+    jobs = max(1, min(jobs or os.cpu_count() or 1, len(entries) or 1))
+    started = time.perf_counter()
+    _batch_init(entries, options)
+    if jobs == 1:
+        results = [_batch_task(index) for index in range(len(entries))]
+    else:
+        methods = multiprocessing.get_all_start_methods()
+        if "fork" in methods:
+            # VFS загружаются до создания пула и достаются воркерам через fork
+            for vfs_path in dict.fromkeys(entry.get("vfs") for entry in entries):
+                _batch_shell(vfs_path)
+            context = multiprocessing.get_context("fork")
+        else:
+            context = multiprocessing.get_context()
+        with context.Pool(jobs, _batch_init, (entries, options)) as pool:
+            results = sorted(pool.imap_unordered(_batch_task, range(len(entries))),
+                             key=lambda result: result["index"])
+    report = {
+        "manifest": manifest_path,
+        "jobs": jobs,
+        "total": len(results),
+        "failed": sum(1 for result in results if result["exit_code"]),
+        "elapsed": round(time.perf_counter() - started, 6),
+        "results": results
+    }
+    if report_path:
+        with open(report_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    else:
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        sys.stdout.write("\n")
+    return 1 if report["failed"] else 0
 
 
 def main():
     vfs_path = None
     startup_script = None
+    headless = False
+    output_path = None
+    lazy_vfs = False
+    convert_path = None
+    cache_bytes = DEFAULT_CONTENT_CACHE_BYTES
+    plan_cache_dir = DEFAULT_PLAN_CACHE_DIR
+    scrollback = DEFAULT_SCROLLBACK
+    scrollback_file = None
+    autosave = False
+    batch_path = None
+    jobs = None
+    report_path = None
+    ps1 = None
+    history_path = DEFAULT_HISTORY_PATH
 
     if len(sys.argv) > 1:
         for arg in sys.argv[1:]:
@@ -472,6 +3252,52 @@ def main():
                 vfs_path = arg.split('=', 1)[1]
             elif arg.startswith('--script='):
                 startup_script = arg.split('=', 1)[1]
+            elif arg == '--headless':
+                headless = True
+            elif arg.startswith('--output='):
+                output_path = arg.split('=', 1)[1]
+            elif arg.startswith('--convert='):
+                convert_path = arg.split('=', 1)[1]
+            elif arg.startswith('--cache-size='):
+                cache_bytes = int(arg.split('=', 1)[1]) * 1024 * 1024
+            elif arg.startswith('--plan-cache='):
+                plan_cache_dir = arg.split('=', 1)[1] or None
+            elif arg == '--lazy-vfs':
+                lazy_vfs = True
+            elif arg == '--autosave':
+                autosave = True
+            elif arg.startswith('--batch='):
+                batch_path = arg.split('=', 1)[1]
+            elif arg.startswith('--jobs='):
+                jobs = int(arg.split('=', 1)[1])
+            elif arg.startswith('--report='):
+                report_path = arg.split('=', 1)[1]
+            elif arg.startswith('--ps1='):
+                ps1 = arg.split('=', 1)[1]
+            elif arg.startswith('--history='):
+                history_path = arg.split('=', 1)[1] or None
+            elif arg.startswith('--scrollback='):
+                scrollback = int(arg.split('=', 1)[1])
+            elif arg.startswith('--scrollback-file='):
+                scrollback_file = arg.split('=', 1)[1]
+
+    if convert_path:
+        if not vfs_path:
+            print("Ошибка: для --convert= нужен исходный образ --vfs=")
+            return 1
+        try:
+            convert_vfs(vfs_path, convert_path)
+        except Exception as e:
+            print(f"Ошибка конвертации VFS: {str(e)}")
+            return 1
+        return 0
+
+    if batch_path:
+        return run_batch(batch_path, jobs, report_path, lazy_vfs, cache_bytes, plan_cache_dir)
+
+    if headless or tk is None:
+        return run_headless(vfs_path, startup_script, output_path, lazy_vfs, cache_bytes,
+                            plan_cache_dir, autosave, ps1)
 
     root = tk.Tk()
     root.geometry("800x600")
@@ -481,15 +3307,21 @@ def main():
     except:
         pass
 
-    terminal = TerminalEmulator(root, vfs_path=vfs_path, startup_script=startup_script)
+    terminal = TerminalEmulator(root, vfs_path=vfs_path, startup_script=startup_script,
+                                scrollback=scrollback, scrollback_file=scrollback_file,
+                                lazy_vfs=lazy_vfs, cache_bytes=cache_bytes,
+                                plan_cache_dir=plan_cache_dir, autosave=autosave, ps1=ps1,
+                                history_path=history_path)
 
     def on_closing():
         root.quit()
 
     root.protocol("WM_DELETE_WINDOW", on_closing)
-    root.mainloop()
+    if terminal.running:
+        root.mainloop()
+    terminal.scrollback.close()
 
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())